@@ -0,0 +1,141 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import AsyncIterable
+
+logger = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: int = 1) -> None:
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, client: str) -> None:
+        self.client = client
+        self.enqueued = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+        self.event = asyncio.Event()
+
+
+class AdmissionController:
+    """
+    Limits the number of requests that run at the same time. Waiting requests
+    are admitted round-robin across clients, so a single client cannot starve
+    the others, and requests that would wait longer than max_queue_time are
+    rejected
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int, max_queue_time: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queue_time = max_queue_time
+        self.active = 0
+        self.queued = 0
+        # client -> waiting tickets, in round-robin order
+        self.queues = OrderedDict()
+        # moving average of the time an admitted request takes
+        self.service_time = 5.0
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        Number of waiting requests that will be admitted before this one
+        """
+        queue = self.queues.get(ticket.client)
+        if queue is None or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        ahead = index
+        for client, q in self.queues.items():
+            if client == ticket.client:
+                continue
+            # clients earlier in the rotation get one more turn before ours
+            precedes = list(self.queues.keys()).index(client) < list(self.queues.keys()).index(ticket.client)
+            ahead += min(len(q), index + (1 if precedes else 0))
+        return ahead
+
+    def estimated_wait(self, ahead: int) -> float:
+        return (ahead + 1) / self.max_concurrent * self.service_time
+
+    def enqueue(self, client: str) -> Ticket:
+        """
+        Returns a ticket that is admitted immediately if there is capacity,
+        and raises Rejected if the request should not be queued
+        """
+        ticket = Ticket(client)
+        if self.active < self.max_concurrent and self.queued == 0:
+            self.admit(ticket)
+            return ticket
+        if self.queued >= self.max_queued:
+            raise Rejected(429, 'too many queued requests', int(self.service_time) + 1)
+        if self.estimated_wait(self.queued) > self.max_queue_time:
+            raise Rejected(503, 'server is overloaded', int(self.service_time) + 1)
+        self.queues.setdefault(client, deque()).append(ticket)
+        self.queued += 1
+        return ticket
+
+    def admit(self, ticket: Ticket) -> None:
+        self.active += 1
+        ticket.admitted_at = time.monotonic()
+        ticket.event.set()
+
+    def dispatch(self) -> None:
+        while self.active < self.max_concurrent and len(self.queues) > 0:
+            client, queue = next(iter(self.queues.items()))
+            ticket = queue.popleft()
+            self.queued -= 1
+            if len(queue) == 0:
+                del self.queues[client]
+            else:
+                self.queues.move_to_end(client)
+            self.admit(ticket)
+
+    def release(self, ticket: Ticket) -> None:
+        """
+        Frees the ticket's slot or its place in the queue - releasing a ticket
+        again does nothing
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted_at is not None:
+            self.active -= 1
+            self.service_time = 0.9 * self.service_time + 0.1 * (time.monotonic() - ticket.admitted_at)
+        else:
+            queue = self.queues.get(ticket.client)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                self.queued -= 1
+                if len(queue) == 0:
+                    del self.queues[ticket.client]
+        self.dispatch()
+
+    async def wait(self, ticket: Ticket, keepalive: float = 5) -> AsyncIterable[int]:
+        """
+        Yields the ticket's queue position whenever it changes, and at least
+        every keepalive seconds, until the ticket is admitted - raises
+        Rejected if the queue time budget runs out
+        """
+        deadline = ticket.enqueued + self.max_queue_time
+        last_position = None
+        last_yield = 0.0
+        while ticket.admitted_at is None:
+            position = self.position(ticket)
+            if position != last_position or time.monotonic() - last_yield >= keepalive:
+                yield position + 1
+                last_position = position
+                last_yield = time.monotonic()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.info(f'rejecting request from {ticket.client} after {self.max_queue_time}s in the queue (position {position + 1})')
+                raise Rejected(503, 'timed out waiting in the queue', int(self.service_time) + 1)
+            try:
+                await asyncio.wait_for(ticket.event.wait(), min(1, remaining))
+            except asyncio.TimeoutError:
+                pass
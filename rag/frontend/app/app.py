@@ -1,27 +1,57 @@
 import sys
 import logging
 import os
+import json
+import socket
+from typing import Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse, RedirectResponse
+from fastapi.responses import StreamingResponse, RedirectResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
-from ingest import ingest_documents
-from query import llm_query, initialize_query_engine
-from db import delete_database
+from jobs import JobManager
+from lease import Lease
+from query import llm_query, initialize_query_engine, warm_up_retriever, check_llm, clear_caches
+from db import delete_database, embeddings
+from sparse import sparse_index
+from admission import AdmissionController, Rejected
+from startup import Startup
+from metrics import queries_total, queries_queued
 
 
-# do not log access to health probes
+# admission control for /api/query
+max_concurrent_queries = int(os.environ.get('MAX_CONCURRENT_QUERIES', 8))
+max_queued_queries = int(os.environ.get('MAX_QUEUED_QUERIES', 64))
+max_queue_time = float(os.environ.get('MAX_QUEUE_TIME', 30))
+
+
+# do not log access to health probes and metrics scrapes
 class EndpointFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
-        return record.getMessage().find("/healthz") == -1 and record.getMessage().find("/livez") == -1 and record.getMessage().find("/readyz") == -1
+        return record.getMessage().find("/healthz") == -1 and record.getMessage().find("/livez") == -1 and record.getMessage().find("/readyz") == -1 and record.getMessage().find("/metrics") == -1
 
 # Filter out health probes
 logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
 app = FastAPI()
 
+admission = AdmissionController(max_concurrent_queries, max_queued_queries, max_queue_time)
+queries_queued.set_function(lambda: admission.queued)
+
+# models are loaded in the background so that the server can bind right away
+startup = Startup([
+    ('embeddings', embeddings.warm_up),
+    ('retriever', warm_up_retriever),
+    ('llm', check_llm),
+])
+
+@app.on_event("startup")
+def start():
+    startup.start()
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 @app.get("/")
@@ -30,36 +60,138 @@ def home():
     return RedirectResponse("/static/index.html")
 
 @app.get("/livez")
-@app.get("/readyz")
 @app.get("/healthz")
 def health():
     return "OK"
 
+@app.get("/readyz")
+def ready():
+    if not startup.ready():
+        return JSONResponse(startup.status, status_code=503)
+    return "OK"
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def ingest_complete(job: dict):
+    # picks up the new snapshot or collection and the new keyword index,
+    # and clears cached answers that may not reflect the new documents
+    if job['state'] == 'succeeded':
+        initialize_query_engine()
+
+jobs = JobManager(ingest_complete)
+
+async def follow_job(job: dict, started: bool):
+    if started:
+        yield f"Started ingest job {job['id']}\n"
+    else:
+        yield f"Ingest job {job['id']} is already running\n"
+    async for text in jobs.follow(job['id']):
+        yield text
 
 @app.get("/api/ingest")
-async def ingest():
-    return StreamingResponse(ingest_documents(), media_type='text/plain')
+def ingest(rebuild: bool = False):
+    """
+    Starts an ingest job, or attaches to the running one, and streams its
+    log - the job continues if the client disconnects
+    """
+    job, started = jobs.submit(rebuild)
+    return StreamingResponse(follow_job(job, started), media_type='text/plain')
+
+@app.post("/api/ingest/jobs")
+def submit_job(rebuild: bool = False):
+    job, started = jobs.submit(rebuild)
+    if not started:
+        return JSONResponse(job, status_code=409)
+    return JSONResponse(job, status_code=202)
+
+@app.get("/api/ingest/jobs")
+def list_jobs():
+    return jobs.list()
+
+@app.get("/api/ingest/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'no ingest job {job_id}')
+    return job
+
+@app.get("/api/ingest/jobs/{job_id}/log")
+def get_job_log(job_id: str, offset: int = 0):
+    """
+    Streams the log of the job from offset (in bytes) until the job is
+    finished
+    """
+    if jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f'no ingest job {job_id}')
+    return StreamingResponse(jobs.follow(job_id, offset), media_type='text/plain')
 
 
 class Prompt(BaseModel):
     prompt: str
+    # follow-up questions with the same session_id continue the conversation
+    session_id: Optional[str] = None
+
+def client_id(request: Request) -> str:
+    # the router adds the client's address to X-Forwarded-For
+    forwarded = request.headers.get('x-forwarded-for')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.client.host if request.client is not None else ''
+
+async def admitted_query(ticket, prompt: str, session_id: Optional[str]):
+    # the response starts right away, queued requests get their position
+    # until they are admitted so that clients and proxies do not time out
+    try:
+        try:
+            async for position in admission.wait(ticket):
+                yield json.dumps({'queue_position': position}) + '\n'
+        except Rejected as e:
+            queries_total.labels('rejected').inc()
+            yield json.dumps({'error': e.reason}) + '\n'
+            return
+        async for line in llm_query(prompt, session_id):
+            yield line
+    finally:
+        admission.release(ticket)
 
 @app.post("/api/query")
 @app.put("/api/query")
-async def query(body: Prompt):
+async def query(body: Prompt, request: Request):
     if body.prompt == '':
         return {'error': 'JSON in request body does not contain prompt'}
-    return StreamingResponse(llm_query(body.prompt), media_type="text/plain")
+    if not startup.ready():
+        return JSONResponse({'error': 'server is starting'}, status_code=503, headers={'Retry-After': '5'})
+    try:
+        ticket = admission.enqueue(client_id(request))
+    except Rejected as e:
+        queries_total.labels('rejected').inc()
+        return JSONResponse({'error': e.reason}, status_code=e.status_code, headers={'Retry-After': str(e.retry_after)})
+    # the background task also releases the ticket if the client disconnects
+    # before the body is iterated, release() does nothing the second time
+    return StreamingResponse(admitted_query(ticket, body.prompt, body.session_id), media_type="text/plain", background=BackgroundTask(admission.release, ticket))
 
 
 # @app.route("/api/deletedb")
 @app.get("/api/deletedb")
 def deletedb():
+    if jobs.running() is not None:
+        raise HTTPException(status_code=409, detail='an ingest job is running')
+    # ingest jobs of other replicas write to the same database
+    lease = Lease(f'{socket.gethostname()}/deletedb')
+    if not lease.acquire():
+        raise HTTPException(status_code=409, detail=f'an ingest job is running ({lease.held_by()})')
     try:
         delete_database()
+        sparse_index.clear()
+        clear_caches()
         return "OK"
     except:
         raise HTTPException(status_code=500, detail='could not delete database')
+    finally:
+        lease.release()
 
 
 @app.get("/api/refreshdb")
@@ -0,0 +1,85 @@
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Callable, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    prompt = re.sub(r'\s+', ' ', prompt.strip().lower())
+    return prompt.rstrip('?!. ')
+
+
+class AnswerCache:
+    """
+    LRU cache of answers (the items streamed by llm_query), looked up by
+    normalized prompt or, if embed is set, by cosine similarity of the prompt
+    embeddings
+    """
+
+    def __init__(self, max_entries: int, ttl: float, similarity_threshold: float, embed: Optional[Callable[[str], List[float]]] = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed if similarity_threshold <= 1 else None
+        # normalized prompt -> (expiry time, normalized embedding, items)
+        self.entries = OrderedDict()
+
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def clear(self) -> None:
+        if len(self.entries) > 0:
+            logger.info(f'clearing {len(self.entries)} cached answers')
+        self.entries.clear()
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (expiry, _, _) in self.entries.items() if expiry < now]:
+            del self.entries[key]
+
+    async def vector(self, key: str) -> Optional[np.ndarray]:
+        if self.embed is None:
+            return None
+        loop = asyncio.get_event_loop()
+        v = np.asarray(await loop.run_in_executor(None, self.embed, key), dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else v
+
+    async def lookup(self, prompt: str) -> Tuple[Optional[List[dict]], Optional[np.ndarray]]:
+        """
+        Returns the cached items (None on a miss) and the prompt's embedding,
+        which should be passed to store() after a miss
+        """
+        if not self.enabled():
+            return None, None
+        self.expire()
+        key = normalize_prompt(prompt)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][2], None
+
+        vector = await self.vector(key)
+        if vector is None or len(self.entries) == 0:
+            return None, vector
+        keys = list(self.entries.keys())
+        similarities = np.stack([self.entries[k][1] for k in keys]) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None, vector
+        self.entries.move_to_end(keys[best])
+        logger.info(f'answer cache hit for "{key}" matched "{keys[best]}" ({similarities[best]:.3f})')
+        return self.entries[keys[best]][2], vector
+
+    def store(self, prompt: str, items: List[dict], vector: Optional[np.ndarray]) -> None:
+        if not self.enabled():
+            return
+        key = normalize_prompt(prompt)
+        self.entries[key] = (time.monotonic() + self.ttl, vector, items)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
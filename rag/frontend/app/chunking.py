@@ -0,0 +1,146 @@
+import os
+import re
+import logging
+from typing import Callable, Optional, Sequence
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# Hugging Face name or path of the served model's tokenizer - chunks and
+# prompts are measured in characters (about 4 per token) if it is not set
+tokenizer_name = os.environ.get("TOKENIZER_NAME", "")
+# in tokens if TOKENIZER_NAME is set, in characters otherwise
+chunk_size = int(os.environ.get("CHUNK_SIZE", 500))
+chunk_overlap = int(os.environ.get("CHUNK_OVERLAP", 50))
+
+tokenizer = None
+tokenizer_loaded = False
+
+
+def get_tokenizer():
+    """
+    Returns the tokenizer, or None if TOKENIZER_NAME is not set or the
+    tokenizer cannot be loaded
+    """
+    global tokenizer, tokenizer_loaded
+    if not tokenizer_loaded:
+        tokenizer_loaded = True
+        if tokenizer_name:
+            try:
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                logger.info(f'counting tokens with the {tokenizer_name} tokenizer')
+            except Exception as e:
+                logger.warning(f'could not load tokenizer {tokenizer_name}, counting characters instead: {e}')
+    return tokenizer
+
+
+def chunk_unit() -> str:
+    return 'tokens' if get_tokenizer() is not None else 'characters'
+
+
+def count_tokens(text: str) -> int:
+    t = get_tokenizer()
+    if t is None:
+        return (len(text) + 3) // 4
+    return len(t.encode(text, add_special_tokens=False))
+
+
+def create_text_splitter() -> TextSplitter:
+    """
+    Splitter that measures chunks in tokens of the served model if
+    TOKENIZER_NAME is set - documents are split one at a time, so chunks
+    never span pages (PDF) or sections (see loaders.group_sections)
+    """
+    t = get_tokenizer()
+    if t is None:
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(t, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def shingles(text: str, n: int = 5) -> set:
+    w = re.findall(r'\w+', text.lower())
+    return set(tuple(w[i:i+n]) for i in range(max(len(w) - n + 1, 1)))
+
+
+def merge_overlap(first: str, second: str, min_overlap: int = 20) -> Optional[str]:
+    """
+    Joins two chunks if the end of first is the start of second (the overlap
+    that the splitter adds between neighbouring chunks), None otherwise
+    """
+    if len(second) < min_overlap:
+        return None
+    head = second[:min_overlap]
+    i = first.find(head)
+    while i != -1:
+        if second.startswith(first[i:]):
+            return first[:i] + second
+        i = first.find(head, i + 1)
+    return None
+
+
+class ContextPacker(BaseDocumentCompressor):
+    """
+    Keeps documents in rank order while they fit in the token budget of the
+    prompt. Neighbouring chunks of the same page are merged so that their
+    overlap is only sent once, and documents that mostly repeat a document
+    that was already kept are dropped
+    """
+
+    # tokens available for the prompt and the question, after leaving room for generation
+    max_prompt_tokens: int
+    # upper limit on the tokens of the documents, 0 for no limit
+    max_context_tokens: int = 0
+    # tokens of the prompt template without the documents and the question
+    template_tokens: int = 0
+    # documents that share this fraction of their 5-word shingles with a kept one are dropped
+    duplicate_threshold: float = 0.8
+    count: Callable[[str], int] = count_tokens
+
+    def merge(self, kept: Document, doc: Document) -> Optional[str]:
+        if kept.metadata.get('source') != doc.metadata.get('source') or kept.metadata.get('page') != doc.metadata.get('page'):
+            return None
+        return merge_overlap(kept.page_content, doc.page_content) or merge_overlap(doc.page_content, kept.page_content)
+
+    def compress_documents(self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None) -> Sequence[Document]:
+        budget = self.max_prompt_tokens - self.template_tokens - self.count(query)
+        if self.max_context_tokens > 0:
+            budget = min(budget, self.max_context_tokens)
+        kept = []
+        kept_shingles = []
+        kept_tokens = []
+        used = 0
+        for doc in documents:
+            s = shingles(doc.page_content)
+            if any(len(s & k) >= self.duplicate_threshold * len(s) for k in kept_shingles):
+                continue
+            merged = None
+            for i, k in enumerate(kept):
+                merged = self.merge(k, doc)
+                if merged is not None:
+                    break
+            if merged is not None:
+                tokens = self.count(merged) + 2
+                if used - kept_tokens[i] + tokens <= budget:
+                    kept[i] = Document(page_content=merged, metadata=kept[i].metadata)
+                    kept_shingles[i] = kept_shingles[i] | s
+                    used += tokens - kept_tokens[i]
+                    kept_tokens[i] = tokens
+                continue
+            # the documents are separated by a blank line
+            tokens = self.count(doc.page_content) + 2
+            if used + tokens > budget:
+                continue
+            kept.append(doc)
+            kept_shingles.append(s)
+            kept_tokens.append(tokens)
+            used += tokens
+        if len(kept) < len(documents):
+            logger.info(f'packed {len(documents)} documents into {len(kept)} with {used} of {budget} context tokens')
+        return kept
+
+    async def acompress_documents(self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None) -> Sequence[Document]:
+        return self.compress_documents(documents, query, callbacks)
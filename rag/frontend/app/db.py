@@ -1,47 +1,390 @@
 import os
+import json
+import time
+import atexit
+import logging
+import shutil
+import tempfile
 import pymilvus
-from typing import List
+from typing import Iterable, List, Dict, Optional
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
 from langchain_community.vectorstores import Milvus
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from embeddings import CachedEmbeddings
+from localstore import LocalVectorStore
+from sparse import SparseIndex
+
+logger = logging.getLogger(__name__)
 
 db_url = os.environ.get('DB_URL', 'http://127.0.0.1:19530')
 
+# milvus, local for a memory-mapped index on the local filesystem that
+# does not need a Milvus deployment, or memory for a local index in shared
+# memory that is discarded on exit (for benchmarks)
+vector_store = os.environ.get('VECTOR_STORE', 'milvus')
+uses_local_store = vector_store in ('local', 'memory')
+vector_store_dir = os.environ.get('VECTOR_STORE_DIR', os.path.join(os.environ.get('TMPDIR', '/tmp'), 'vector-store'))
+# float16 halves the size of the local index at a small cost in recall
+vector_store_dtype = os.environ.get('VECTOR_STORE_DTYPE', 'float16')
+# s3://bucket/prefix - local index snapshots are uploaded there after
+# ingestion and loaded from there at startup
+vector_store_s3_uri = os.environ.get('VECTOR_STORE_S3_URI')
+
 # For embeddings model, the example uses a sentence-transformers model
 # https://www.sbert.net/docs/pretrained_models.html 
 # "The all-mpnet-base-v2 model provides the best quality, while all-MiniLM-L6-v2 is 5 times faster and still offers good quality."
 embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME", "all-MiniLM-L6-v2")
 
+# an alias of the collection that holds the chunks, so that ingestion can
+# build a new collection and swap it in atomically
 collection_name = 'LangChainCollection'
 
-embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+# one record per ingested file (key, etag, size, number of chunks) so that
+# ingestion only needs to process new and changed files
+index_collection_name = 'IngestIndex'
+
+embeddings = CachedEmbeddings(model_name=embeddings_model_name)
+
+local_store = None
 
-def get_db_connection() -> Milvus:
+def get_local_store() -> LocalVectorStore:
+    global local_store
+    if local_store is None:
+        if vector_store == 'memory':
+            path = tempfile.mkdtemp(prefix='vector-store-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            atexit.register(shutil.rmtree, path, True)
+            local_store = LocalVectorStore(embeddings, path, 'float32')
+        else:
+            local_store = LocalVectorStore(embeddings, vector_store_dir, vector_store_dtype, vector_store_s3_uri)
+    return local_store
+
+def get_db_connection(collection: Optional[str] = None) -> VectorStore:
+    if uses_local_store:
+        store = get_local_store()
+        # picks up snapshots written by other replicas
+        store.load()
+        return store
     address = db_url
     if address.startswith('http://'):
         address = address[len('http://'):]
     elif address.startswith('https://'):
         address = address[len('https://'):]
-    return Milvus(connection_args={'address': address}, embedding_function=embeddings, auto_id=True)
+    return Milvus(connection_args={'address': address}, collection_name=collection or collection_name, embedding_function=embeddings, auto_id=True)
+
+def search_by_vectors(db: VectorStore, vectors: List[List[float]], k: int) -> List[List[Document]]:
+    """
+    Returns the k nearest chunks of each vector, searching for all of them
+    in one request
+    """
+    if isinstance(db, LocalVectorStore):
+        return db.similarity_search_by_vectors(vectors, k)
+    if db.col is None:
+        return [[] for _ in vectors]
+    # the same fields and parsing as Milvus.similarity_search_with_score_by_vector
+    output_fields = [f for f in db.fields if f != db._vector_field]
+    results = db.col.search(data=vectors, anns_field=db._vector_field, param=db.search_params, limit=k, output_fields=output_fields, timeout=db.timeout)
+    return [[db._parse_document({f: hit.entity.get(f) for f in output_fields}) for hit in hits] for hits in results]
+
+def persist_database():
+    """
+    Makes the chunks added since the last call searchable - Milvus does this
+    on its own, the local store writes a new snapshot
+    """
+    if uses_local_store:
+        get_local_store().persist()
+
+def has_unpersisted_changes() -> bool:
+    """
+    Whether the local store has chunks added or deleted by an ingestion
+    that failed before persist_database()
+    """
+    return uses_local_store and get_local_store().has_staging()
 
 def delete_database():
+    if uses_local_store:
+        get_local_store().clear()
+        return
+    client = pymilvus.MilvusClient(uri=db_url)
+    live = aliased_collection(client)
+    if live is not None:
+        client.drop_alias(collection_name)
+        client.drop_collection(live)
+    else:
+        client.drop_collection(collection_name)
+    drop_shadow_collections(client)
+    client.drop_collection(index_collection_name)
+
+def aliased_collection(client: pymilvus.MilvusClient) -> Optional[str]:
+    """
+    Returns the collection that collection_name is an alias of, None if it
+    is not an alias
+    """
+    try:
+        return client.describe_alias(collection_name).get('collection_name')
+    except pymilvus.exceptions.MilvusException:
+        return None
+
+def drop_shadow_collections(client: pymilvus.MilvusClient, keep: Optional[str] = None):
+    """
+    Drops the collections of interrupted ingestions - only called while
+    holding the ingest lease, so the shadow collections of other writers
+    are from leases that expired
+    """
+    live = aliased_collection(client)
+    for name in client.list_collections():
+        if name.startswith(collection_name + '_') and name not in (live, keep):
+            client.drop_collection(name)
+
+def drop_shadow_collection(shadow: str):
+    """
+    Drops the collection of an ingestion that failed
+    """
     client = pymilvus.MilvusClient(uri=db_url)
-    client.drop_collection(collection_name)
+    if client.has_collection(shadow):
+        client.drop_collection(shadow)
+
+def collection_exists(name: str) -> bool:
+    return pymilvus.MilvusClient(uri=db_url).has_collection(name)
+
+def live_collection_matches() -> bool:
+    """
+    Whether chunks can be added to the live collection - it must exist and
+    its vectors must have the dimension of the embeddings model, which they
+    do not after the model changed
+    """
+    if not collection_exists(collection_name):
+        return False
+    pymilvus.connections.connect(uri=db_url)
+    dims = [f.params.get('dim') for f in pymilvus.Collection(collection_name).schema.fields if f.dtype == pymilvus.DataType.FLOAT_VECTOR]
+    return dims == [len(embeddings.embed_query('dimension'))]
+
+def create_shadow_collection() -> str:
+    """
+    Returns the name of a new collection for chunks - it is created when the
+    first chunks are added with get_db_connection(name). The caller must hold
+    the ingest lease
+    """
+    drop_shadow_collections(pymilvus.MilvusClient(uri=db_url))
+    return f'{collection_name}_{time.time_ns()}'
+
+def swap_collection(shadow: str):
+    """
+    Points collection_name at shadow and drops the collection it replaces -
+    queries see either the old or the new chunks, never a partial ingestion
+    """
+    client = pymilvus.MilvusClient(uri=db_url)
+    # chunks inserted by this client must be visible to the other clients
+    pymilvus.connections.connect(uri=db_url)
+    pymilvus.Collection(shadow).flush()
+    client.load_collection(shadow)
+    old = aliased_collection(client)
+    if old is not None:
+        client.alter_alias(shadow, collection_name)
+        client.drop_collection(old)
+        return
+    if client.has_collection(collection_name):
+        # a collection created before aliases were used - the chunks are
+        # not searchable until the alias is created
+        client.drop_collection(collection_name)
+    client.create_alias(shadow, collection_name)
+
+def milvus_string_list(values: List[str]) -> str:
+    # JSON string literals are valid in Milvus boolean expressions
+    return '[' + ','.join(json.dumps(v) for v in values) + ']'
+
+def ensure_ingest_index(client: pymilvus.MilvusClient):
+    if client.has_collection(index_collection_name):
+        return
+    schema = pymilvus.MilvusClient.create_schema(auto_id=False, enable_dynamic_field=False)
+    schema.add_field(field_name='key', datatype=pymilvus.DataType.VARCHAR, is_primary=True, max_length=65535)
+    schema.add_field(field_name='etag', datatype=pymilvus.DataType.VARCHAR, max_length=256)
+    schema.add_field(field_name='size', datatype=pymilvus.DataType.INT64)
+    schema.add_field(field_name='chunks', datatype=pymilvus.DataType.INT64)
+    # Milvus requires every collection to have a vector field
+    schema.add_field(field_name='vector', datatype=pymilvus.DataType.FLOAT_VECTOR, dim=2)
+    index_params = pymilvus.MilvusClient.prepare_index_params()
+    index_params.add_index(field_name='vector', index_type='FLAT', metric_type='L2')
+    client.create_collection(index_collection_name, schema=schema, index_params=index_params)
+
+def get_ingest_index() -> Dict[str, dict]:
+    """
+    Returns the ingested files keyed on the S3 key
+    """
+    if uses_local_store:
+        return get_local_store().read_json('ingest-index.json', {})
+    client = pymilvus.MilvusClient(uri=db_url)
+    if not client.has_collection(index_collection_name):
+        return {}
+    pymilvus.connections.connect(uri=db_url)
+    collection = pymilvus.Collection(index_collection_name)
+    collection.load()
+    index = {}
+    query_iterator = collection.query_iterator(batch_size=1000, output_fields=['key', 'etag', 'size', 'chunks'])
+    while True:
+        records = query_iterator.next()
+        if len(records) == 0:
+            break
+        for record in records:
+            index[record['key']] = {'etag': record['etag'], 'size': record['size'], 'chunks': record['chunks']}
+    query_iterator.close()
+    return index
+
+def update_ingest_index(records: List[dict]):
+    """
+    Records files as ingested - each record needs key, etag, size and chunks
+    """
+    if len(records) == 0:
+        return
+    if uses_local_store:
+        store = get_local_store()
+        with store.lock:
+            index = store.read_json('ingest-index.json', {})
+            for r in records:
+                index[r['key']] = {'etag': r['etag'], 'size': r['size'], 'chunks': r['chunks']}
+            store.write_json('ingest-index.json', index)
+        return
+    client = pymilvus.MilvusClient(uri=db_url)
+    ensure_ingest_index(client)
+    client.upsert(index_collection_name, [dict(r, vector=[0.0, 0.0]) for r in records])
+
+def remove_from_ingest_index(keys: List[str]):
+    if len(keys) == 0:
+        return
+    if uses_local_store:
+        store = get_local_store()
+        with store.lock:
+            index = store.read_json('ingest-index.json', {})
+            for k in keys:
+                index.pop(k, None)
+            store.write_json('ingest-index.json', index)
+        return
+    client = pymilvus.MilvusClient(uri=db_url)
+    if client.has_collection(index_collection_name):
+        client.delete(index_collection_name, filter=f'key in {milvus_string_list(keys)}')
+
+def delete_sources(sources: List[str]):
+    """
+    Deletes all chunks that came from the given sources
+    """
+    if len(sources) == 0:
+        return
+    if uses_local_store:
+        get_local_store().delete_sources(sources)
+        return
+    client = pymilvus.MilvusClient(uri=db_url)
+    if not client.has_collection(collection_name):
+        return
+    # keep the expressions short for large deletes
+    for i in range(0, len(sources), 100):
+        client.delete(collection_name, filter=f'source in {milvus_string_list(sources[i:i+100])}')
+
+def chunk_ids(sources: List[str]) -> Dict[str, List[int]]:
+    """
+    Returns the primary keys of the live chunks of the given sources, so
+    that they can be deleted once the sources have new chunks
+    """
+    ids = {}
+    client = pymilvus.MilvusClient(uri=db_url)
+    if len(sources) == 0 or not client.has_collection(collection_name):
+        return ids
+    for i in range(0, len(sources), 100):
+        for record in client.query(collection_name, filter=f'source in {milvus_string_list(sources[i:i+100])}', output_fields=['pk', 'source']):
+            ids.setdefault(record['source'], []).append(record['pk'])
+    return ids
+
+def delete_chunks(ids: List[int]):
+    if len(ids) == 0:
+        return
+    client = pymilvus.MilvusClient(uri=db_url)
+    for i in range(0, len(ids), 1000):
+        client.delete(collection_name, ids=ids[i:i+1000])
+
+def delete_new_chunks(sources: List[str], keep: Dict[str, List[int]]):
+    """
+    Deletes the chunks of sources that are not in keep (their chunks before
+    the ingestion) - undoes a partial ingestion of the sources
+    """
+    client = pymilvus.MilvusClient(uri=db_url)
+    if len(sources) == 0 or not client.has_collection(collection_name):
+        return
+    unknown = [s for s in sources if len(keep.get(s, [])) == 0]
+    for i in range(0, len(unknown), 100):
+        client.delete(collection_name, filter=f'source in {milvus_string_list(unknown[i:i+100])}')
+    for s in sources:
+        if len(keep.get(s, [])) > 0:
+            client.delete(collection_name, filter=f'source == {json.dumps(s)} and pk not in {keep[s]}')
+
+def restore_sources(sources: List[str]):
+    """
+    Undoes delete_sources() for sources whose chunks were not replaced -
+    only possible with the local store, where deletes take effect in
+    persist_database()
+    """
+    if uses_local_store:
+        get_local_store().restore_sources(sources)
 
 def get_existing_sources() -> List[str]:
+    if uses_local_store:
+        return list(get_local_store().sources())
     pymilvus.connections.connect(uri=db_url)
     try:
         collection = pymilvus.Collection(collection_name)
     except pymilvus.exceptions.SchemaNotReadyException:
         return []
     collection.load()
-    sources = []
-    query_iterator = collection.query_iterator(100, 65536, '', ['source'])
+    sources = set()
+    query_iterator = collection.query_iterator(batch_size=1000, output_fields=['source'])
     while True:
         docs = query_iterator.next()
         if len(docs) == 0:
             break
         for doc in docs:
-            source = doc.get("source")
-            if source not in sources:
-                sources.append(source)
-    return sources
\ No newline at end of file
+            sources.add(doc.get("source"))
+    query_iterator.close()
+    return list(sources)
+
+def live_chunks(batch_size: int = 1000) -> Iterable[List[Document]]:
+    """
+    Yields the searchable chunks in batches
+    """
+    if uses_local_store:
+        yield from get_local_store().documents(batch_size)
+        return
+    client = pymilvus.MilvusClient(uri=db_url)
+    if not client.has_collection(collection_name):
+        return
+    pymilvus.connections.connect(uri=db_url)
+    collection = pymilvus.Collection(collection_name)
+    collection.load()
+    # the fields of Milvus(), text and the metadata of the chunks
+    fields = [f.name for f in collection.schema.fields if not f.is_primary and f.dtype != pymilvus.DataType.FLOAT_VECTOR]
+    query_iterator = collection.query_iterator(batch_size=batch_size, output_fields=fields)
+    while True:
+        records = query_iterator.next()
+        if len(records) == 0:
+            break
+        yield [Document(page_content=r['text'], metadata={f: r[f] for f in fields if f != 'text'}) for r in records]
+    query_iterator.close()
+
+def sync_sparse_index(index: SparseIndex) -> bool:
+    """
+    Rebuilds the keyword index from all chunks in the database if it was not
+    built for the current ingest index - returns whether it was rebuilt
+    """
+    # read before the chunks, so that chunks of a later ingestion make the
+    # index out of date rather than marking it current
+    ingest_index = get_ingest_index()
+    if index.built_for(ingest_index):
+        return False
+    logger.info('keyword index is missing or out of date, rebuilding it from the database')
+    index.rebuild(live_chunks(), ingest_index)
+    return True
+
+def build_sparse_index(index: SparseIndex) -> int:
+    """
+    Builds the keyword index after an ingestion and records the ingest index
+    it corresponds to - returns the number of chunks
+    """
+    chunks = index.build()
+    index.mark_built_for(get_ingest_index())
+    return chunks
@@ -0,0 +1,186 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import List, Dict, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from metrics import span, query_stage_seconds
+
+logger = logging.getLogger(__name__)
+
+# torch (sentence-transformers), onnx or onnx-int8 (CPU only)
+embeddings_backend = os.environ.get("EMBEDDINGS_BACKEND", "torch")
+embeddings_device = os.environ.get("EMBEDDINGS_DEVICE")
+embeddings_batch_size = int(os.environ.get("EMBEDDINGS_BATCH_SIZE", 64))
+# 0 leaves the number of intra-op threads to the backend
+embeddings_threads = int(os.environ.get("EMBEDDINGS_THREADS", 0))
+# set to an empty string to disable the cache
+embeddings_cache_path = os.environ.get("EMBEDDINGS_CACHE", os.path.join(os.environ.get("TMPDIR", "/tmp"), "embeddings-cache.sqlite"))
+# exported (and quantized) ONNX models - point this at a persistent volume
+# so that new pods do not have to export the models again
+model_cache_dir = os.environ.get("MODEL_CACHE_DIR", os.path.join(os.environ.get("TMPDIR", "/tmp"), "onnx"))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingsCache:
+    """
+    Persistent cache of embeddings keyed on (model, sha256 of the text)
+    """
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))')
+        self.conn.commit()
+
+    def get(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self.lock:
+            # stay below SQLite's limit on the number of parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i+500]
+                rows = self.conn.execute(
+                    f'SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({",".join("?" * len(batch))})',
+                    [model] + batch
+                )
+                for h, vector in rows:
+                    found[h] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)',
+                [(model, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in vectors.items()]
+            )
+            self.conn.commit()
+
+
+class SentenceTransformerBackend:
+    def __init__(self, model_name: str, device: Optional[str], threads: int) -> None:
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device=device)
+
+    def encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+
+class OnnxBackend:
+    """
+    Runs the transformer with onnxruntime on the CPU, optionally quantized to
+    int8, and applies the mean pooling and normalization that the
+    sentence-transformers models (e.g. all-MiniLM-L6-v2) use
+    """
+
+    def __init__(self, model_name: str, threads: int, quantize: bool) -> None:
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise Exception(f'the {embeddings_backend} embeddings backend needs optimum[onnxruntime]: {e}')
+
+        if '/' not in model_name and not os.path.isdir(model_name):
+            model_name = 'sentence-transformers/' + model_name
+        session_options = onnxruntime.SessionOptions()
+        if threads > 0:
+            session_options.intra_op_num_threads = threads
+        export_dir = os.path.join(model_cache_dir, model_name.replace('/', '--'))
+        if not os.path.isfile(os.path.join(export_dir, 'model.onnx')):
+            ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(export_dir)
+        file_name = 'model.onnx'
+        if quantize:
+            if not os.path.isfile(os.path.join(export_dir, 'model_quantized.onnx')):
+                quantizer = ORTQuantizer.from_pretrained(export_dir)
+                quantizer.quantize(save_dir=export_dir, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+            file_name = 'model_quantized.onnx'
+        self.model = ORTModelForFeatureExtraction.from_pretrained(export_dir, file_name=file_name, session_options=session_options)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[i:i+batch_size], padding=True, truncation=True, return_tensors='np')
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.append(pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None))
+        return np.concatenate(vectors)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings with a configurable backend, batch size and number of threads,
+    that only computes the embeddings of texts it has not seen before.
+    The model is loaded on first use or by calling load()
+    """
+
+    def __init__(self, model_name: str, backend: str = embeddings_backend, device: Optional[str] = embeddings_device, batch_size: int = embeddings_batch_size, threads: int = embeddings_threads, cache_path: str = embeddings_cache_path) -> None:
+        if backend not in ('torch', 'onnx', 'onnx-int8'):
+            raise Exception(f'unknown embeddings backend {backend}')
+        self.model_name = model_name
+        self.backend_name = backend
+        self.device = device
+        self.threads = threads
+        self.batch_size = batch_size
+        self.backend = None
+        self.load_lock = threading.Lock()
+        # quantized models produce slightly different vectors
+        self.cache_key = f'{model_name}:{backend}'
+        self.cache = None
+        if cache_path:
+            try:
+                self.cache = EmbeddingsCache(cache_path)
+            except Exception as e:
+                logger.warning(f'could not open embeddings cache {cache_path}: {e}')
+
+    def load(self):
+        with self.load_lock:
+            if self.backend is None:
+                if self.backend_name == 'torch':
+                    self.backend = SentenceTransformerBackend(self.model_name, self.device, self.threads)
+                else:
+                    self.backend = OnnxBackend(self.model_name, self.threads, self.backend_name == 'onnx-int8')
+                logger.info(f'loaded embeddings model {self.model_name}, backend {self.backend_name}, batch size {self.batch_size}, cache {"enabled" if self.cache else "disabled"}')
+        return self.backend
+
+    def warm_up(self) -> None:
+        # the first inference is slow (memory allocation, kernel selection)
+        self.load().encode(['warm up'], self.batch_size)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [t.replace("\n", " ") for t in texts]
+        if self.cache is None:
+            return self.load().encode(texts, self.batch_size).tolist()
+
+        hashes = [text_hash(t) for t in texts]
+        found = self.cache.get(self.cache_key, list(set(hashes)))
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found:
+                missing[h] = t
+        if len(missing) > 0:
+            vectors = self.load().encode(list(missing.values()), self.batch_size).tolist()
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put(self.cache_key, computed)
+            found.update(computed)
+        return [found[h] for h in hashes]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # queries are not cached, they are rarely repeated word for word
+        return self.load().encode([t.replace("\n", " ") for t in texts], self.batch_size).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        with span('embed_query', query_stage_seconds.labels('embed_query')):
+            return self.embed_queries([text])[0]
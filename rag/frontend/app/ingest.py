@@ -1,207 +1,473 @@
 #!/usr/bin/env python3
 import os
-from typing import List, AsyncIterable
+from typing import List, Dict, AsyncIterable, Callable, Optional
 import asyncio
-import functools
-from db import get_db_connection, get_existing_sources
-import boto3
+import concurrent.futures
+import multiprocessing
+import time
+from db import get_db_connection, get_existing_sources, get_ingest_index, update_ingest_index, remove_from_ingest_index, delete_sources, persist_database, has_unpersisted_changes, restore_sources, uses_local_store, create_shadow_collection, drop_shadow_collection, collection_exists, live_collection_matches, chunk_ids, delete_chunks, delete_new_chunks, swap_collection, sync_sparse_index, build_sparse_index
 import os
 import tempfile
 from urllib.parse import urljoin
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import (
-    CSVLoader,
-    EverNoteLoader,
-    PyMuPDFLoader,
-    TextLoader,
-    UnstructuredEPubLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredODTLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredWordDocumentLoader,
-)
+from langchain.docstore.document import Document
+from loaders import LOADER_MAPPING, IN_MEMORY_EXTENSIONS, get_extension, load_document, load_bytes
+import storage
+from chunking import create_text_splitter, chunk_size, chunk_unit
+from sparse import SparseIndex, sparse_index
+from lease import Lease
+from metrics import span, ingest_stage_seconds, ingest_files_total, ingest_documents_total, ingest_chunks_total, ingest_bytes_total
 
 
 # Load environment variables
 bucket_name = os.environ.get("SOURCE_BUCKET", "documents")
 docs_url = os.environ.get("DOCS_URL")
 tmpdir = os.environ.get("TMPDIR")
-chunk_size = 500
-chunk_overlap = 50
-
-
-# Map file extensions to document loaders and their arguments
-LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    ".doc": (UnstructuredWordDocumentLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
-    ".epub": (UnstructuredEPubLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PyMuPDFLoader, {}),
-    ".ppt": (UnstructuredPowerPointLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
-    # Add more mappings for other file extensions and loaders as needed
-}
+
+# pipeline tuning
+download_concurrency = int(os.environ.get("DOWNLOAD_CONCURRENCY", 4))
+# files that are downloaded (or read into memory) but not parsed yet - each
+# file is deleted once it is parsed, so this bounds disk and memory use
+download_ahead = int(os.environ.get("DOWNLOAD_AHEAD", 16))
+loader_processes = int(os.environ.get("LOADER_PROCESSES", os.cpu_count() or 1))
+embed_batch_size = int(os.environ.get("EMBED_BATCH_SIZE", 256))
+# maximum number of files waiting between two stages
+pipeline_queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", 8))
+
+
+def list_bucket() -> Dict[str, dict]:
+    """
+    Returns the etag and size of every object in the bucket that passes the
+    SOURCE_PREFIX, SOURCE_INCLUDE and SOURCE_EXCLUDE filters, keyed on the S3 key
+    """
+    return dict(storage.list_objects(bucket_name))
 
 def get_file_list() -> List[str]:
-    session = boto3.session.Session()
-    client = session.client(service_name='s3')
-    resp = client.list_objects_v2(Bucket=bucket_name)
-    if resp is None or resp.get('Contents') is None:
-        return []
-
-    contents = resp.get('Contents')
-    return [f.get('Key') for f in contents]
-
-def download_files_to_dir(dir: str, files: List[str]):
-    session = boto3.session.Session()
-    client = session.client(service_name='s3')
-    for f in files:
-        full_path = os.path.join(dir, f)
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        client.download_file(bucket_name, f, full_path)
-
-def download_files_to_dir(dir: str, files: List[str]):
-    session = boto3.session.Session()
-    client = session.client(service_name='s3')
-    for f in files:
-        full_path = os.path.join(dir, f)
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        client.download_file(bucket_name, f, full_path)
-    client.close()
+    return list(list_bucket().keys())
+
+def is_supported(f: str) -> bool:
+    return get_extension(f) in LOADER_MAPPING
+
+class StageStats:
+    def __init__(self, name: str, unit: str) -> None:
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.files = 0
+
+    def add(self, count: float, files: int = 1) -> None:
+        self.count += count
+        self.files += files
+
+    def report(self, wall: float) -> str:
+        return f"{self.name}: {self.files} files, {round(self.count, 1)} {self.unit} ({self.count / max(wall, 0.001):.1f}/s)"
 
 class Ingester:
-    texts = None
+    """
+    Streams files through download -> load -> split -> embed stages with
+    bounded queues between them, so that memory does not grow with the
+    number of files and all stages run at the same time
+    """
 
-    def __init__(self, bucket_name) -> None:
+    def __init__(self, bucket_name, db, on_files_complete: Optional[Callable[[Dict[str, int]], None]] = None, sparse_index: Optional[SparseIndex] = None) -> None:
         self.bucket_name = bucket_name
+        self.db = db
+        # stored chunks are also added to the keyword index if set
+        self.sparse_index = sparse_index
+        # called (in a thread) with the number of chunks of every file whose chunks are all in the database
+        self.on_files_complete = on_files_complete
+        # files that were loaded successfully, with the number of chunks each produced
+        self.chunk_counts = {}
+        self.stats = {
+            'download': StageStats('downloaded', 'MB'),
+            'load': StageStats('loaded', 'documents'),
+            'split': StageStats('split', 'chunks'),
+            'embed': StageStats('embedded', 'chunks'),
+        }
+
+    def fix_metadata(self, file_path: str, load_result: List[Document]) -> None:
+        for doc in load_result:
+            doc.metadata['source'] = file_path
+            if docs_url is None:
+                doc.metadata['file_path'] = f"s3://{self.bucket_name}/{file_path}"
+            else:
+                doc.metadata['file_path'] = urljoin(docs_url, file_path)
+                if file_path.endswith('.pdf') and doc.metadata.get('page') is not None:
+                    # we add 1 because PyMuPDF page numbers are zero-based
+                    doc.metadata['page'] += 1
+                    doc.metadata['file_path'] += f"#page={ doc.metadata.get('page') }"
+            if doc.metadata.get('page') is None:
+                doc.metadata['page'] = -1
+            if doc.metadata.get('total_pages') is None:
+                doc.metadata['total_pages'] = 0
+            if doc.metadata.get('format') is None:
+                doc.metadata['format'] = ''
+            if doc.metadata.get('section') is None:
+                doc.metadata['section'] = ''
+            if doc.metadata.get('title') is None:
+                doc.metadata['title'] = ''
+            if doc.metadata.get('author') is None:
+                doc.metadata['author'] = ''
+            if doc.metadata.get('subject') is None:
+                doc.metadata['subject'] = ''
+            if doc.metadata.get('keywords') is None:
+                doc.metadata['keywords'] = ''
+            if doc.metadata.get('creator') is None:
+                doc.metadata['creator'] = ''
+            if doc.metadata.get('producer') is None:
+                doc.metadata['producer'] = ''
+            if doc.metadata.get('creationDate') is None:
+                doc.metadata['creationDate'] = ''
+            if doc.metadata.get('modDate') is None:
+                doc.metadata['modDate'] = ''
+            if doc.metadata.get('trapped') is None:
+                doc.metadata['trapped'] = ''
+
+    async def download_stage(self, files: List[str], temp_dir: str, ahead: asyncio.Semaphore, out: asyncio.Queue, progress: asyncio.Queue) -> None:
+        loop = asyncio.get_event_loop()
+        client = storage.client()
+        pending = list(reversed(files))
+
+        def fetch(file_path: str):
+            if get_extension(file_path) in IN_MEMORY_EXTENSIONS:
+                return storage.read_object(client, self.bucket_name, file_path, temp_dir)
+            return None, storage.download_file(client, self.bucket_name, file_path, temp_dir)
+
+        async def worker():
+            while len(pending) > 0:
+                file_path = pending.pop()
+                # released by the load stage once the file is parsed
+                await ahead.acquire()
+                try:
+                    with span('download', ingest_stage_seconds.labels('download'), file=file_path):
+                        data, filesystem_path = await loop.run_in_executor(None, fetch, file_path)
+                except Exception as e:
+                    ahead.release()
+                    await progress.put(f"Exception caught while downloading {file_path}: {e}\n")
+                    continue
+                size = len(data) if data is not None else os.stat(filesystem_path).st_size
+                self.stats['download'].add(size / (1024*1024))
+                ingest_files_total.labels('download').inc()
+                ingest_bytes_total.inc(size)
+                await out.put((file_path, filesystem_path, data))
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(download_concurrency)])
+        finally:
+            client.close()
+        await out.put(None)
+
+    async def load_stage(self, pool: concurrent.futures.Executor, total_files: int, ahead: asyncio.Semaphore, inq: asyncio.Queue, out: asyncio.Queue, progress: asyncio.Queue) -> None:
+        loop = asyncio.get_event_loop()
+
+        async def worker():
+            while True:
+                item = await inq.get()
+                if item is None:
+                    # let the other workers see the end of the stream
+                    await inq.put(None)
+                    return
+                file_path, filesystem_path, data = item
+                try:
+                    with span('load', ingest_stage_seconds.labels('load'), file=file_path):
+                        if data is not None:
+                            load_result = await loop.run_in_executor(pool, load_bytes, file_path, data)
+                        else:
+                            load_result = await loop.run_in_executor(pool, load_document, filesystem_path)
+                except Exception as e:
+                    await progress.put(f"Exception caught while loading document {file_path}: {e}\n")
+                    continue
+                finally:
+                    if filesystem_path is not None:
+                        os.remove(filesystem_path)
+                    ahead.release()
+                self.stats['load'].add(len(load_result))
+                ingest_files_total.labels('load').inc()
+                ingest_documents_total.inc(len(load_result))
+                self.fix_metadata(file_path, load_result)
+                await progress.put(f"Loaded {file_path} ({self.stats['load'].files} / {total_files}), {len(load_result)} documents\n")
+                await out.put((file_path, load_result))
+
+        await asyncio.gather(*[worker() for _ in range(loader_processes)])
+        await out.put(None)
+
+    async def split_stage(self, inq: asyncio.Queue, out: asyncio.Queue) -> None:
+        loop = asyncio.get_event_loop()
+        text_splitter = await loop.run_in_executor(None, create_text_splitter)
+        while True:
+            item = await inq.get()
+            if item is None:
+                break
+            file_path, documents = item
+            with span('split', ingest_stage_seconds.labels('split'), file=file_path):
+                texts = await loop.run_in_executor(None, text_splitter.split_documents, documents)
+            self.stats['split'].add(len(texts))
+            ingest_files_total.labels('split').inc()
+            ingest_chunks_total.labels('split').inc(len(texts))
+            self.chunk_counts[file_path] = len(texts)
+            await out.put((file_path, texts))
+        await out.put(None)
+
+    async def embed_stage(self, inq: asyncio.Queue) -> None:
+        loop = asyncio.get_event_loop()
+        batch = []
+        # chunks of each file that are not in the database yet
+        remaining = {}
 
-    async def load_documents_and_split(self, ignored_files: List[str] = []) -> AsyncIterable[str]:
+        async def flush():
+            if len(batch) > 0:
+                with span('embed', ingest_stage_seconds.labels('embed'), chunks=len(batch)):
+                    await loop.run_in_executor(None, self.db.add_documents, list(batch))
+                    if self.sparse_index is not None:
+                        await loop.run_in_executor(None, self.sparse_index.add, list(batch))
+                for text in batch:
+                    remaining[text.metadata['source']] -= 1
+            complete = {f: self.chunk_counts[f] for f, n in remaining.items() if n == 0}
+            self.stats['embed'].add(len(batch), len(complete))
+            ingest_files_total.labels('embed').inc(len(complete))
+            ingest_chunks_total.labels('embed').inc(len(batch))
+            batch.clear()
+            for f in complete:
+                del remaining[f]
+            if len(complete) > 0 and self.on_files_complete is not None:
+                await loop.run_in_executor(None, self.on_files_complete, complete)
+
+        while True:
+            item = await inq.get()
+            if item is None:
+                break
+            file_path, texts = item
+            remaining[file_path] = len(texts)
+            batch.extend(texts)
+            if len(batch) >= embed_batch_size:
+                await flush()
+        await flush()
+
+    def report(self, start: float) -> str:
+        wall = time.monotonic() - start
+        return ", ".join(stats.report(wall) for stats in self.stats.values()) + "\n"
+
+    async def ingest(self, files: List[str] = None) -> AsyncIterable[str]:
         """
-        Loads all documents from the source documents directory, ignoring specified files
+        Loads, splits and embeds the specified documents (all documents in the bucket if files is None)
         """
-        loop = asyncio.get_event_loop()
         yield(f"Loading documents from {self.bucket_name}\n")
+        if files is None:
+            files = get_file_list()
         filtered_files = []
-        for f in get_file_list():
-            if f in ignored_files:
-                continue
-            ext = "." + f.rsplit(".", 1)[-1]
+        for f in files:
+            ext = get_extension(f)
             if ext not in LOADER_MAPPING:
                 yield(f"Unsupported file extension '{ext}'\n")
                 continue
             filtered_files.append(f)
-        total_files = len(filtered_files)
-        documents = []
+        if len(filtered_files) == 0:
+            yield("Did not load any documents\n")
+            return
 
+        start = time.monotonic()
+        downloaded = asyncio.Queue(maxsize=pipeline_queue_size)
+        loaded = asyncio.Queue(maxsize=pipeline_queue_size)
+        split = asyncio.Queue(maxsize=pipeline_queue_size)
+        progress = asyncio.Queue()
+        ahead = asyncio.Semaphore(download_ahead)
+
+        # loaders are CPU-bound and hold the GIL, so they run in separate
+        # processes; spawn avoids forking a process with torch threads
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=loader_processes, mp_context=multiprocessing.get_context('spawn'))
         with tempfile.TemporaryDirectory(dir=tmpdir) as temp_dir:
-            download_future =  loop.run_in_executor(None, download_files_to_dir, temp_dir, filtered_files)
-            while not download_future.done():
-                yield(f"Still downloading files from {self.bucket_name}...\n")
-                await asyncio.wait([download_future], timeout=5)
-
-            for i, file_path in enumerate(filtered_files):
-                yield(f"Loading {file_path} ({i+1} / {total_files})\n")
-                ext = "." + file_path.rsplit(".", 1)[-1]
-                loader_class, loader_args = LOADER_MAPPING[ext]
-                filesystem_path = os.path.join(temp_dir, file_path)
-                yield(f"file system path={filesystem_path}, file size={round(os.stat(filesystem_path).st_size / (1024*1024), 2)}MB, loader={loader_class.__name__}\n")
-                loader = loader_class(filesystem_path, **loader_args)
-                loader_future = loop.run_in_executor(None, loader.load)
-                while not loader_future.done():
-                    yield(f"Still loading {file_path}...\n")
-                    await asyncio.wait([loader_future], timeout=5)
-                try:
-                    load_result = loader_future.result()
-                except Exception as e:
-                    yield(f"Exception caught while loading document {filesystem_path}: {e}\n")
-                    continue
-                # fix metadata
-                for doc in load_result:
-                    doc.metadata['source'] = file_path
-                    if docs_url is None:
-                        doc.metadata['file_path'] = f"s3://{self.bucket_name}/{file_path}"
+            stages = [
+                asyncio.create_task(self.download_stage(filtered_files, temp_dir, ahead, downloaded, progress)),
+                asyncio.create_task(self.load_stage(pool, len(filtered_files), ahead, downloaded, loaded, progress)),
+                asyncio.create_task(self.split_stage(loaded, split)),
+                asyncio.create_task(self.embed_stage(split)),
+            ]
+            pipeline = asyncio.gather(*stages)
+            get_progress = None
+            try:
+                while True:
+                    if get_progress is None:
+                        get_progress = asyncio.ensure_future(progress.get())
+                    done, _ = await asyncio.wait([get_progress, pipeline], timeout=5, return_when=asyncio.FIRST_COMPLETED)
+                    if get_progress in done:
+                        yield get_progress.result()
+                        get_progress = None
+                    elif pipeline in done:
+                        break
                     else:
-                        doc.metadata['file_path'] = urljoin(docs_url, file_path)
-                        if file_path.endswith('.pdf') and doc.metadata.get('page') is not None:
-                            # we add 1 because PyMuPDF page numbers are zero-based
-                            doc.metadata['page'] += 1
-                            doc.metadata['file_path'] += f"#page={ doc.metadata.get('page') }"
-                    if doc.metadata.get('page') is None:
-                        doc.metadata['page'] = -1
-                    if doc.metadata.get('total_pages') is None:
-                        doc.metadata['total_pages'] = 0
-                    if doc.metadata.get('format') is None:
-                        doc.metadata['format'] = ''
-                    if doc.metadata.get('title') is None:
-                        doc.metadata['title'] = ''
-                    if doc.metadata.get('author') is None:
-                        doc.metadata['author'] = ''
-                    if doc.metadata.get('subject') is None:
-                        doc.metadata['subject'] = ''
-                    if doc.metadata.get('keywords') is None:
-                        doc.metadata['keywords'] = ''
-                    if doc.metadata.get('creator') is None:
-                        doc.metadata['creator'] = ''
-                    if doc.metadata.get('producer') is None:
-                        doc.metadata['producer'] = ''
-                    if doc.metadata.get('creationDate') is None:
-                        doc.metadata['creationDate'] = ''
-                    if doc.metadata.get('modDate') is None:
-                        doc.metadata['modDate'] = ''
-                    if doc.metadata.get('trapped') is None:
-                        doc.metadata['trapped'] = ''
-                documents.extend(load_result)
-
-        if len(documents) == 0:
-            yield("Did not load any documents\n")
-            return
+                        yield self.report(start)
+                while not progress.empty():
+                    yield progress.get_nowait()
+                if pipeline.exception() is not None:
+                    # the caller must not treat a partial ingestion as complete
+                    raise pipeline.exception()
+            finally:
+                if get_progress is not None:
+                    get_progress.cancel()
+                for stage in stages:
+                    stage.cancel()
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        yield self.report(start)
+        yield(f"Split into {self.stats['split'].count} chunks of text (max. {chunk_size} {chunk_unit()} each)\n")
 
-        yield(f"Loaded {len(documents)} new documents from {self.bucket_name}\n")
-        splitter_future = loop.run_in_executor(None, functools.partial(RecursiveCharacterTextSplitter, chunk_size=chunk_size, chunk_overlap=chunk_overlap))
-        while not splitter_future.done():
-            yield("Still splitting documents...\n")
-            await asyncio.wait([splitter_future], timeout=5)
-        text_splitter = splitter_future.result()
-        texts_future = loop.run_in_executor(None, text_splitter.split_documents, documents)
-        while not texts_future.done():
-            yield("Still splitting documents...\n")
-            await asyncio.wait([texts_future], timeout=5)
-        texts = texts_future.result()
-        yield(f"Split into {len(texts)} chunks of text (max. {chunk_size} tokens each)\n")
-        self.texts = texts
-
-async def ingest_documents() -> AsyncIterable[str]:
-    ingester = Ingester(bucket_name)
-
-    ignored_files = get_existing_sources()
-    if len(ignored_files) > 0:
-        yield(f"ignoring {ignored_files}\n")
-    db = get_db_connection()
-
-    async for line in ingester.load_documents_and_split(ignored_files):
-        yield line
-    if ingester.texts is None:
+async def ingest_documents(rebuild: bool = False, lease: Optional[Lease] = None) -> AsyncIterable[str]:
+    """
+    Ingests new and changed files and removes the chunks of changed and
+    removed files - all files are ingested again if rebuild is set. Queries
+    see the new chunks once ingestion is complete with the local store, which
+    switches to a new snapshot, and once each file is complete with Milvus -
+    unless all files are ingested again into a shadow collection that
+    replaces the live one. The caller must hold the ingest lease, which is
+    checked before the ingestion is made complete
+    """
+    loop = asyncio.get_event_loop()
+    listing = await loop.run_in_executor(None, list_bucket)
+    listing = {k: v for k, v in listing.items() if is_supported(k)}
+    index = await loop.run_in_executor(None, get_ingest_index)
+    if len(index) == 0 or rebuild:
+        # chunks ingested before the index existed - we cannot tell whether
+        # they are current, so they are replaced
+        for source in await loop.run_in_executor(None, get_existing_sources):
+            index.setdefault(source, None)
+        if rebuild:
+            index = {k: None for k in index}
+        for k in index:
+            if index[k] is None:
+                index[k] = {'etag': None, 'size': None, 'chunks': None}
+
+    new_files = [k for k in listing if k not in index]
+    changed_files = [k for k in listing if k in index and (index[k]['etag'] != listing[k]['etag'] or index[k]['size'] != listing[k]['size'])]
+    removed_files = [k for k in index if k not in listing]
+    yield(f"{len(listing)} files in {bucket_name}: {len(new_files)} new, {len(changed_files)} changed, {len(removed_files)} removed, {len(listing) - len(new_files) - len(changed_files)} unchanged\n")
+
+    # the chunks of unchanged files must be in the keyword index, which is
+    # not the case on a new pod or after another replica ingested files
+    if not rebuild and await loop.run_in_executor(None, sync_sparse_index, sparse_index) and len(index) > 0:
+        yield("Rebuilt the keyword index from the database\n")
+
+    # keyword index chunks of this ingestion, they replace the chunks of
+    # their files once it succeeds
+    staged_sparse = SparseIndex(os.path.join(sparse_index.path, 'staging'))
+    if uses_local_store:
+        # chunks of files that a failed ingestion recorded stay staged
+        await loop.run_in_executor(None, staged_sparse.delete_sources, changed_files + removed_files)
+    else:
+        await loop.run_in_executor(None, staged_sparse.clear)
+
+    # Milvus makes chunks searchable as they are added. New chunks are added
+    # to the live collection and the chunks they replace are deleted file by
+    # file, unless all files are ingested again (rebuild, or the embeddings
+    # model changed) - then they are added to a shadow collection that
+    # replaces the live one
+    to_ingest = new_files + changed_files
+    shadow = None
+    replaced_ids = {}
+    if not uses_local_store and len(to_ingest) > 0:
+        if rebuild or not await loop.run_in_executor(None, live_collection_matches):
+            if not rebuild and len(index) > 0:
+                yield(f"The current collection does not match the embeddings model, ingesting all {len(listing)} files again\n")
+            to_ingest = list(listing)
+            shadow = await loop.run_in_executor(None, create_shadow_collection)
+        else:
+            replaced_ids = await loop.run_in_executor(None, chunk_ids, changed_files)
+
+    if uses_local_store and len(changed_files) + len(removed_files) > 0:
+        # the local store only deletes them in persist_database(), and
+        # changed files stay in the index until their new chunks are added
+        yield(f"Deleting chunks of {len(changed_files) + len(removed_files)} changed and removed files\n")
+        await loop.run_in_executor(None, delete_sources, changed_files + removed_files)
+        await loop.run_in_executor(None, remove_from_ingest_index, removed_files)
+
+    if len(to_ingest) == 0:
+        if len(removed_files) > 0 or await loop.run_in_executor(None, has_unpersisted_changes):
+            if lease is not None:
+                lease.check()
+            if not uses_local_store:
+                yield(f"Deleting chunks of {len(removed_files)} removed files\n")
+                await loop.run_in_executor(None, delete_sources, removed_files)
+                await loop.run_in_executor(None, remove_from_ingest_index, removed_files)
+            await loop.run_in_executor(None, sparse_index.replace_sources, removed_files, staged_sparse)
+            await loop.run_in_executor(None, persist_database)
+            await loop.run_in_executor(None, build_sparse_index, sparse_index)
+        yield("Ingestion complete\n")
         return
 
-    yield(f"Creating embeddings in vector database, may a few minutes...\n")
+    ingested = {}
+    records = []
 
-    loop = asyncio.get_event_loop()
-    embeddings_future = loop.run_in_executor(None, db.add_documents, ingester.texts)
-    while not embeddings_future.done():
-        yield("embeddings thread still running...\n")
-        await asyncio.wait([embeddings_future], timeout=5)
-
-    embeddings_exception = embeddings_future.exception()
-    if embeddings_exception:
-        yield(f"Exception caught while creating embeddings: {embeddings_exception}\n")
+    def record_files(chunk_counts: Dict[str, int]):
+        ingested.update(chunk_counts)
+        if shadow is not None:
+            # recorded once the shadow collection is live
+            records.extend(dict(listing[k], key=k, chunks=n) for k, n in chunk_counts.items())
+            return
+        # files are recorded as soon as all their chunks are in the database,
+        # so an interrupted ingestion does not have to start over
+        update_ingest_index([dict(listing[k], key=k, chunks=n) for k, n in chunk_counts.items()])
+        # queries see either the old or the new chunks of a file, and both
+        # for a moment, but never none of them
+        delete_chunks([i for k in chunk_counts for i in replaced_ids.pop(k, [])])
+
+    ingester = Ingester(bucket_name, get_db_connection(shadow), record_files, staged_sparse)
+    try:
+        async for line in ingester.ingest(to_ingest):
+            yield line
+        if lease is not None:
+            lease.check()
+    except Exception:
+        if shadow is not None:
+            # queries keep using the current collection
+            yield(f"Ingestion failed, dropping collection {shadow}\n")
+            await loop.run_in_executor(None, drop_shadow_collection, shadow)
+            await loop.run_in_executor(None, staged_sparse.clear)
+        elif not uses_local_store:
+            # files that were ingested completely keep their new chunks, the
+            # others keep their current ones
+            partial = [k for k in to_ingest if k not in ingested]
+            yield(f"Ingestion failed, keeping the current chunks of {len(partial)} files\n")
+            await loop.run_in_executor(None, delete_new_chunks, partial, replaced_ids)
+            await loop.run_in_executor(None, staged_sparse.delete_sources, partial)
+            await loop.run_in_executor(None, sparse_index.replace_sources, list(ingested), staged_sparse)
+            await loop.run_in_executor(None, build_sparse_index, sparse_index)
+        raise
+
+    if shadow is not None:
+        # files that could not be ingested again have no chunks any more
+        not_replaced = []
+        dropped = [k for k in index if k not in ingested]
+        replaced = list(ingested) + dropped + list(await loop.run_in_executor(None, sparse_index.sources))
+    else:
+        # changed files that could not be loaded keep their current chunks
+        # and are ingested again next time
+        not_replaced = [k for k in changed_files if k not in ingested]
+        dropped = removed_files
+        replaced = list(ingested) + dropped
+    if len(not_replaced) > 0:
+        yield(f"Keeping the current chunks of {len(not_replaced)} changed files that were not ingested\n")
+    if shadow is not None:
+        if not await loop.run_in_executor(None, collection_exists, shadow):
+            # none of the files had any text, there is nothing to swap in
+            yield("No chunks were added, keeping the current collection\n")
+            await loop.run_in_executor(None, delete_sources, replaced)
+        else:
+            yield(f"Switching to collection {shadow}\n")
+            await loop.run_in_executor(None, swap_collection, shadow)
+        await loop.run_in_executor(None, remove_from_ingest_index, dropped)
+        await loop.run_in_executor(None, update_ingest_index, records)
+    elif not uses_local_store:
+        await loop.run_in_executor(None, delete_new_chunks, [k for k in to_ingest if k not in ingested], replaced_ids)
+        if len(removed_files) > 0:
+            yield(f"Deleting chunks of {len(removed_files)} removed files\n")
+            await loop.run_in_executor(None, delete_sources, removed_files)
+            await loop.run_in_executor(None, remove_from_ingest_index, removed_files)
     else:
-        yield(f"Ingestion complete\n")
+        await loop.run_in_executor(None, restore_sources, not_replaced)
+    await loop.run_in_executor(None, sparse_index.replace_sources, replaced, staged_sparse)
+    await loop.run_in_executor(None, persist_database)
+    yield("Building keyword index\n")
+    chunks = await loop.run_in_executor(None, build_sparse_index, sparse_index)
+    yield(f"Keyword index contains {chunks} chunks\n")
+    yield(f"Ingestion complete\n")
 
 
 async def main():
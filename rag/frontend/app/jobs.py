@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Ingestion jobs - each job runs ingest_documents() in a separate process with
+a limited number of CPUs (in a thread of the server with the memory vector
+store), and writes its progress to a log that any client can stream while
+the job runs and after it is complete. A lease in S3 makes
+sure that only one job of all replicas writes to the database at a time
+
+    <JOBS_DIR>/<job id>/status.json
+    <JOBS_DIR>/<job id>/log.txt
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import asyncio
+import logging
+import subprocess
+import threading
+from typing import AsyncIterable, Callable, List, Optional
+from lease import Lease
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> int:
+    """
+    Number of CPUs this container may use - the CPU limit of the cgroup if
+    it has one, sched_getaffinity() returns all CPUs of the node
+    """
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max', encoding='utf-8') as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', encoding='utf-8') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', encoding='utf-8') as f:
+                period = f.read().strip()
+        except OSError:
+            return cpus
+    if quota in ('max', '-1'):
+        return cpus
+    return max(min(cpus, -(-int(quota) // int(period))), 1)
+
+
+jobs_dir = os.environ.get('JOBS_DIR', os.path.join(os.environ.get('TMPDIR', '/tmp'), 'ingest-jobs'))
+# CPUs that an ingestion job may use, the rest are left to queries
+ingest_cpus = int(os.environ.get('INGEST_CPUS', max(available_cpus() // 2, 1)))
+# the job runs at a lower priority than the server
+ingest_nice = int(os.environ.get('INGEST_NICE', 10))
+# number of finished jobs whose logs are kept
+ingest_jobs_kept = int(os.environ.get('INGEST_JOBS_KEPT', 20))
+# the memory vector store only exists in the server process, so jobs run
+# in a thread of the server, without the CPU and priority limits
+in_process = os.environ.get('VECTOR_STORE', 'milvus') == 'memory'
+
+FINISHED = ('succeeded', 'failed')
+
+
+def job_path(job_id: str, name: str = '') -> str:
+    return os.path.join(jobs_dir, job_id, name)
+
+
+def read_status(job_id: str) -> Optional[dict]:
+    try:
+        with open(job_path(job_id, 'status.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_status(job_id: str, **changes) -> dict:
+    status = read_status(job_id) or {'id': job_id}
+    status.update(changes)
+    tmp = job_path(job_id, 'status.json.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(tmp, job_path(job_id, 'status.json'))
+    return status
+
+
+def is_alive(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobManager:
+    """
+    Starts ingestion jobs and reports their status - on_complete is called
+    (in a thread) with the status of every job that this server started when
+    its process exits
+    """
+
+    def __init__(self, on_complete: Optional[Callable[[dict], None]] = None) -> None:
+        self.on_complete = on_complete
+        self.lock = threading.Lock()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        status = read_status(job_id)
+        if status is None or status['state'] in FINISHED:
+            return status
+        if status.get('pid') is None:
+            # the server stopped before it started the job
+            lost = time.time() - status['created'] > 60
+        elif status.get('in_process'):
+            # the server that ran the job was restarted
+            lost = status['pid'] != os.getpid()
+        else:
+            # the job process was killed, e.g. when the container was restarted
+            lost = not is_alive(status['pid'])
+        if lost:
+            status = write_status(job_id, state='failed', finished=time.time(), error='job process exited unexpectedly')
+        return status
+
+    def list(self) -> List[dict]:
+        if not os.path.isdir(jobs_dir):
+            return []
+        jobs = [self.get(entry) for entry in sorted(os.listdir(jobs_dir), reverse=True) if os.path.isdir(job_path(entry))]
+        return [job for job in jobs if job is not None]
+
+    def running(self) -> Optional[dict]:
+        for job in self.list():
+            if job['state'] not in FINISHED:
+                return job
+        return None
+
+    def submit(self, rebuild: bool = False) -> tuple:
+        """
+        Starts a job unless one is running - returns the status of the job
+        and whether it was started
+        """
+        with self.lock:
+            job = self.running()
+            if job is not None:
+                return job, False
+            self.prune()
+            job_id = f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:6]}'
+            os.makedirs(job_path(job_id))
+            open(job_path(job_id, 'log.txt'), 'w').close()
+            write_status(job_id, state='queued', rebuild=rebuild, created=time.time())
+            if in_process:
+                job = write_status(job_id, pid=os.getpid(), in_process=True)
+                logger.info(f'started ingest job {job_id} in the server process')
+                threading.Thread(target=lambda: self.finish(job_id, run(job_id, limit=False)), daemon=True).start()
+                return job, True
+            env = dict(os.environ)
+            # sizes the thread and process pools of the job to its CPUs
+            env.setdefault('LOADER_PROCESSES', str(ingest_cpus))
+            env['OMP_NUM_THREADS'] = str(ingest_cpus)
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), job_id],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env,
+                stdin=subprocess.DEVNULL,
+            )
+            job = write_status(job_id, pid=process.pid)
+            logger.info(f'started ingest job {job_id} (pid {process.pid})')
+            threading.Thread(target=self.wait, args=(job_id, process), daemon=True).start()
+            return job, True
+
+    def wait(self, job_id: str, process: subprocess.Popen) -> None:
+        self.finish(job_id, process.wait())
+
+    def finish(self, job_id: str, code: int) -> None:
+        status = read_status(job_id)
+        if status['state'] not in FINISHED:
+            status = write_status(job_id, state='failed', finished=time.time(), error=f'job process exited with code {code}')
+        logger.info(f"ingest job {job_id} {status['state']}")
+        if self.on_complete is not None:
+            try:
+                self.on_complete(status)
+            except Exception as e:
+                logger.error(f'error after ingest job {job_id}: {e}')
+
+    def prune(self) -> None:
+        finished = [job for job in self.list() if job['state'] in FINISHED]
+        for job in finished[ingest_jobs_kept:]:
+            shutil.rmtree(job_path(job['id']), ignore_errors=True)
+
+    async def follow(self, job_id: str, offset: int = 0, poll_interval: float = 0.5) -> AsyncIterable[str]:
+        """
+        Yields the lines of the log of the job from offset (in bytes) until
+        the job is finished
+        """
+        with open(job_path(job_id, 'log.txt'), 'rb') as f:
+            f.seek(offset)
+            partial = b''
+            while True:
+                data = partial + f.read()
+                end = data.rfind(b'\n') + 1
+                partial = data[end:]
+                if end > 0:
+                    yield data[:end].decode('utf-8', errors='replace')
+                    continue
+                status = self.get(job_id)
+                if status is None or status['state'] in FINISHED:
+                    # the job may have written more before it finished
+                    data = partial + f.read()
+                    if data != b'':
+                        yield data.decode('utf-8', errors='replace')
+                    if status is not None and status['state'] == 'failed' and status.get('error'):
+                        yield f"Ingest job {job_id} failed: {status['error']}\n"
+                    return
+                await asyncio.sleep(poll_interval)
+
+
+def limit_resources() -> None:
+    cpus = sorted(os.sched_getaffinity(0))
+    if ingest_cpus < len(cpus):
+        # the last CPUs, the scheduler tends to start with the first ones
+        os.sched_setaffinity(0, cpus[-ingest_cpus:])
+    os.nice(ingest_nice)
+
+
+def run(job_id: str, limit: bool = True) -> int:
+    """
+    Runs the job in this process - loader processes inherit its CPU affinity
+    and priority if limit is set
+    """
+    lease = Lease(f'{socket.gethostname()}/{job_id}')
+    try:
+        acquired = lease.acquire()
+    except Exception as e:
+        write_status(job_id, state='failed', finished=time.time(), error=f'could not take the ingest lease: {e}')
+        return 1
+    if not acquired:
+        write_status(job_id, state='failed', finished=time.time(), error=f'another ingest job is running ({lease.held_by()})')
+        return 1
+    if limit:
+        limit_resources()
+    status = write_status(job_id, state='running', started=time.time())
+
+    with open(job_path(job_id, 'log.txt'), 'a', encoding='utf-8') as log:
+        async def ingest():
+            # imported here so that the models are loaded after the CPUs are limited
+            from ingest import ingest_documents
+            async for line in ingest_documents(status.get('rebuild', False), lease):
+                log.write(line)
+                log.flush()
+
+        try:
+            asyncio.run(ingest())
+        except Exception as e:
+            log.write(f"Exception caught while ingesting documents: {e}\n")
+            write_status(job_id, state='failed', finished=time.time(), error=f'{type(e).__name__}: {e}')
+            return 1
+        finally:
+            lease.release()
+    write_status(job_id, state='succeeded', finished=time.time())
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    sys.exit(run(sys.argv[1]))
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlparse
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# an object that ingestion takes before it writes to the database, so that
+# only one replica writes at a time - it is in S3 because the database is
+# shared by all replicas and the jobs directory is not
+ingest_lease_uri = os.environ.get('INGEST_LEASE_URI', f"s3://{os.environ.get('SOURCE_BUCKET', 'documents')}/.ingest.lease")
+# a lease that is not renewed for this many seconds can be taken over
+ingest_lease_ttl = float(os.environ.get('INGEST_LEASE_TTL', 120))
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+    """
+    Exclusive lease that is taken with conditional writes and renewed in the
+    background while it is held. The age of a lease is measured with the
+    clock of the S3 server, so the clocks of the replicas do not matter
+    """
+
+    def __init__(self, holder: str, uri: str = ingest_lease_uri, ttl: float = ingest_lease_ttl) -> None:
+        url = urlparse(uri)
+        self.bucket = url.netloc
+        self.key = url.path.lstrip('/')
+        self.holder = holder
+        self.ttl = ttl
+        self.client = boto3.session.Session().client(service_name='s3')
+        self.etag = None
+        self.renewed = 0.0
+        self.lost = False
+        self.stopped = threading.Event()
+        # renewals and release do not overlap
+        self.lock = threading.Lock()
+
+    def current(self) -> Optional[dict]:
+        """
+        Returns the holder, ttl, etag and age (in seconds) of the lease, None
+        if nobody holds it
+        """
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        record = json.loads(response['Body'].read())
+        now = parsedate_to_datetime(response['ResponseMetadata']['HTTPHeaders']['date'])
+        record['etag'] = response['ETag']
+        record['age'] = (now - response['LastModified']).total_seconds()
+        return record
+
+    def write(self, **condition) -> bool:
+        sent = time.monotonic()
+        try:
+            response = self.client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps({'holder': self.holder, 'ttl': self.ttl}).encode('utf-8'), **condition)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        self.etag = response['ETag']
+        self.renewed = sent
+        return True
+
+    def acquire(self) -> bool:
+        """
+        Takes the lease if nobody holds it or if it expired
+        """
+        record = self.current()
+        if record is None:
+            taken = self.write(IfNoneMatch='*')
+        elif record['age'] > record.get('ttl', self.ttl):
+            logger.info(f"taking over the expired ingest lease of {record['holder']}")
+            taken = self.write(IfMatch=record['etag'])
+        else:
+            return False
+        if taken:
+            threading.Thread(target=self.renew, name='lease', daemon=True).start()
+        return taken
+
+    def held_by(self) -> str:
+        record = self.current()
+        return record['holder'] if record is not None else 'nobody'
+
+    def renew(self) -> None:
+        while not self.stopped.wait(self.ttl / 4):
+            try:
+                with self.lock:
+                    if self.stopped.is_set():
+                        return
+                    renewed = self.write(IfMatch=self.etag)
+                if not renewed:
+                    logger.error(f'ingest lease was taken over by {self.held_by()}')
+                    self.lost = True
+                    return
+            except Exception as e:
+                logger.warning(f'could not renew ingest lease: {e}')
+
+    def check(self) -> None:
+        """
+        Raises LeaseLost unless the lease is still held - called before
+        changes that other writers must not overlap with
+        """
+        if self.lost or time.monotonic() - self.renewed > self.ttl:
+            raise LeaseLost('the ingest lease expired, another ingestion may have taken over')
+
+    def release(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            if self.lost or self.etag is None:
+                return
+            record = self.current()
+            if record is not None and record['etag'] == self.etag:
+                self.client.delete_object(Bucket=self.bucket, Key=self.key)
+            self.etag = None
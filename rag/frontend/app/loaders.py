@@ -0,0 +1,117 @@
+import io
+import csv
+from typing import List
+from langchain.docstore.document import Document
+from langchain_community.document_loaders import (
+    CSVLoader,
+    EverNoteLoader,
+    PyMuPDFLoader,
+    TextLoader,
+    UnstructuredEPubLoader,
+    UnstructuredHTMLLoader,
+    UnstructuredMarkdownLoader,
+    UnstructuredODTLoader,
+    UnstructuredPowerPointLoader,
+    UnstructuredWordDocumentLoader,
+)
+
+# This module is imported by the loader worker processes, so it should not
+# import anything heavy (embeddings models, database connections).
+
+
+# Map file extensions to document loaders and their arguments - the
+# Unstructured loaders return elements, which are grouped into sections
+LOADER_MAPPING = {
+    ".csv": (CSVLoader, {}),
+    ".doc": (UnstructuredWordDocumentLoader, {"mode": "elements"}),
+    ".docx": (UnstructuredWordDocumentLoader, {"mode": "elements"}),
+    ".enex": (EverNoteLoader, {}),
+    ".epub": (UnstructuredEPubLoader, {"mode": "elements"}),
+    ".html": (UnstructuredHTMLLoader, {"mode": "elements"}),
+    ".md": (UnstructuredMarkdownLoader, {"mode": "elements"}),
+    ".odt": (UnstructuredODTLoader, {"mode": "elements"}),
+    ".pdf": (PyMuPDFLoader, {}),
+    ".ppt": (UnstructuredPowerPointLoader, {"mode": "elements"}),
+    ".pptx": (UnstructuredPowerPointLoader, {"mode": "elements"}),
+    ".txt": (TextLoader, {"encoding": "utf8"}),
+    # Add more mappings for other file extensions and loaders as needed
+}
+
+# formats that are parsed from the contents of the object, without writing
+# it to a file
+IN_MEMORY_EXTENSIONS = (".txt", ".md", ".csv", ".html")
+
+def get_extension(file_path: str) -> str:
+    return "." + file_path.rsplit(".", 1)[-1]
+
+def load_document(filesystem_path: str) -> List[Document]:
+    """
+    Loads a single file with the loader for its extension - runs in a worker process
+    """
+    loader_class, loader_args = LOADER_MAPPING[get_extension(filesystem_path)]
+    loader = loader_class(filesystem_path, **loader_args)
+    if loader_args.get("mode") == "elements":
+        return group_sections(loader.load())
+    return loader.load()
+
+def load_bytes(file_path: str, data: bytes) -> List[Document]:
+    """
+    Loads a file of one of the IN_MEMORY_EXTENSIONS from its contents, with
+    the same results as load_document - runs in a worker process
+    """
+    ext = get_extension(file_path)
+    text = data.decode("utf-8")
+    if ext == ".txt":
+        return [Document(page_content=text, metadata={"source": file_path})]
+    if ext == ".csv":
+        # the same format as CSVLoader
+        docs = []
+        for i, row in enumerate(csv.DictReader(io.StringIO(text))):
+            content = "\n".join(f"{k.strip() if k is not None else k}: {v.strip() if isinstance(v, str) else v}" for k, v in row.items())
+            docs.append(Document(page_content=content, metadata={"source": file_path, "row": i}))
+        return docs
+    if ext == ".md":
+        from unstructured.partition.md import partition_md
+        elements = partition_md(text=text)
+    elif ext == ".html":
+        from unstructured.partition.html import partition_html
+        elements = partition_html(text=text)
+    else:
+        raise Exception(f"cannot load {ext} files from memory")
+    # the same metadata as the Unstructured loaders in elements mode
+    docs = []
+    for element in elements:
+        metadata = {"source": file_path}
+        metadata.update(element.metadata.to_dict())
+        metadata["category"] = element.category
+        docs.append(Document(page_content=str(element), metadata=metadata))
+    return group_sections(docs)
+
+def group_sections(elements: List[Document]) -> List[Document]:
+    """
+    Merges Unstructured elements into one document per section - a section
+    starts at a title or a new page
+    """
+    sections = []
+    texts = []
+    metadata = None
+    section = ""
+    for element in elements:
+        page = element.metadata.get("page_number")
+        is_title = element.metadata.get("category") == "Title"
+        if is_title:
+            section = element.page_content
+        if metadata is not None and (is_title or page != metadata.get("page")):
+            sections.append(Document(page_content="\n\n".join(texts), metadata=metadata))
+            metadata = None
+        if metadata is None:
+            texts = []
+            # a section that continues on the next page keeps its title
+            metadata = {"section": section}
+            if page is not None:
+                metadata["page"] = page
+        if element.page_content.strip() != "":
+            texts.append(element.page_content)
+    if metadata is not None:
+        sections.append(Document(page_content="\n\n".join(texts), metadata=metadata))
+    return [s for s in sections if s.page_content.strip() != ""]
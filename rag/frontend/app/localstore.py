@@ -0,0 +1,449 @@
+import os
+import json
+import mmap
+import time
+import shutil
+import logging
+import threading
+from typing import Any, Iterable, List, Optional, Set, Tuple, Type
+from urllib.parse import urlparse
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# below this number of vectors a brute-force search is fast enough
+ivf_min_rows = int(os.environ.get("VECTOR_STORE_IVF_MIN_ROWS", 20000))
+# number of IVF lists that are searched
+ivf_nprobe = int(os.environ.get("VECTOR_STORE_NPROBE", 8))
+# rows per block in brute-force searches, bounds the memory used by a search
+search_block_rows = 65536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+def kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10) -> np.ndarray:
+    """
+    Spherical k-means on a sample of the vectors, returns the centroids
+    """
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(len(vectors), size=min(len(vectors), n_lists * 64), replace=False)].astype(np.float32)
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = sample[assignment == c]
+            if len(members) > 0:
+                centroids[c] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Vector store that keeps normalized embeddings in a memory-mapped matrix,
+    with an IVF index once there are more than ivf_min_rows vectors.
+
+    Added documents are staged on disk and become searchable when persist()
+    writes a new snapshot and atomically switches to it. A snapshot is a
+    directory that contains:
+
+        vectors.npy         embeddings (float16 or float32)
+        docs.jsonl          page content and metadata of each row
+        offsets.npy         offset of each row in docs.jsonl
+        centroids.npy       IVF centroids (only for large snapshots)
+        lists.npy           row numbers grouped by IVF list
+        list_offsets.npy    start of each IVF list in lists.npy
+
+    Snapshots are also uploaded to s3_uri if it is set, so that other
+    replicas can load them at startup.
+    """
+
+    def __init__(self, embedding: Embeddings, path: str, dtype: str = 'float16', s3_uri: Optional[str] = None) -> None:
+        self.embedding = embedding
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.s3_uri = s3_uri
+        self.lock = threading.RLock()
+        self.snapshot = None
+        # realpath of the open snapshot, and ETag of the CURRENT object in S3
+        # that it was downloaded for
+        self.snapshot_dir = None
+        self.current_etag = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    @classmethod
+    def from_texts(cls: Type['LocalVectorStore'], texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any) -> 'LocalVectorStore':
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        store.persist()
+        return store
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def write_json(self, name: str, value: Any) -> None:
+        tmp = self.file(name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp, self.file(name))
+
+    def read_json(self, name: str, default: Any) -> Any:
+        if not os.path.isfile(self.file(name)):
+            return default
+        with open(self.file(name), encoding='utf-8') as f:
+            return json.load(f)
+
+    # staging
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        vectors = normalize(np.asarray(self.embedding.embed_documents(texts), dtype=np.float32))
+        with self.lock:
+            staging = self.read_json('staging.json', {'dim': vectors.shape[1], 'rows': 0})
+            with open(self.file('staging-vectors.f32'), 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.file('staging-docs.jsonl'), 'a', encoding='utf-8') as f:
+                for text, metadata in zip(texts, metadatas):
+                    f.write(json.dumps({'page_content': text, 'metadata': metadata}) + '\n')
+            first = staging['rows']
+            staging['rows'] += len(texts)
+            self.write_json('staging.json', staging)
+        return [f'staged-{first + i}' for i in range(len(texts))]
+
+    def read_staging(self) -> Tuple[np.ndarray, List[str]]:
+        staging = self.read_json('staging.json', None)
+        if staging is None:
+            return np.zeros((0, 0), dtype=np.float32), []
+        vectors = np.fromfile(self.file('staging-vectors.f32'), dtype=np.float32).reshape(-1, staging['dim'])[:staging['rows']]
+        with open(self.file('staging-docs.jsonl'), encoding='utf-8') as f:
+            lines = [line for _, line in zip(range(staging['rows']), f)]
+        return vectors, lines
+
+    def clear_staging(self) -> None:
+        for name in ('staging.json', 'staging-vectors.f32', 'staging-docs.jsonl', 'deleted-sources.json'):
+            if os.path.isfile(self.file(name)):
+                os.remove(self.file(name))
+
+    def delete_sources(self, sources: List[str]) -> None:
+        """
+        Removes the rows of the given sources from the next snapshot
+        """
+        if len(sources) == 0:
+            return
+        with self.lock:
+            deleted = set(self.read_json('deleted-sources.json', []))
+            deleted.update(sources)
+            self.write_json('deleted-sources.json', sorted(deleted))
+            vectors, lines = self.read_staging()
+            keep = [i for i, line in enumerate(lines) if json.loads(line)['metadata'].get('source') not in deleted]
+            if len(keep) < len(lines):
+                with open(self.file('staging-vectors.f32'), 'wb') as f:
+                    f.write(vectors[keep].tobytes())
+                with open(self.file('staging-docs.jsonl'), 'w', encoding='utf-8') as f:
+                    f.writelines(lines[i] for i in keep)
+                self.write_json('staging.json', {'dim': vectors.shape[1], 'rows': len(keep)})
+
+    def restore_sources(self, sources: List[str]) -> None:
+        """
+        Keeps the rows of the given sources in the next snapshot after all,
+        e.g. of changed files that could not be loaded again
+        """
+        if len(sources) == 0:
+            return
+        with self.lock:
+            deleted = set(self.read_json('deleted-sources.json', [])) - set(sources)
+            if len(deleted) > 0:
+                self.write_json('deleted-sources.json', sorted(deleted))
+            elif os.path.isfile(self.file('deleted-sources.json')):
+                os.remove(self.file('deleted-sources.json'))
+
+    def has_staging(self) -> bool:
+        """
+        Whether rows were added or deleted since the last snapshot
+        """
+        return any(os.path.isfile(self.file(name)) for name in ('staging.json', 'deleted-sources.json'))
+
+    def sources(self) -> Set[str]:
+        with self.lock:
+            sources = set()
+            snapshot = self.snapshot
+            if snapshot is not None:
+                for n in range(len(snapshot['offsets'])):
+                    sources.add(self.document(snapshot, n).metadata.get('source'))
+            sources -= set(self.read_json('deleted-sources.json', []))
+            for line in self.read_staging()[1]:
+                sources.add(json.loads(line)['metadata'].get('source'))
+            return sources
+
+    def documents(self, batch_size: int = 1000) -> Iterable[List[Document]]:
+        """
+        Yields the rows of the current snapshot in batches
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        for start in range(0, len(snapshot['offsets']), batch_size):
+            yield [self.document(snapshot, n) for n in range(start, min(start + batch_size, len(snapshot['offsets'])))]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.snapshot = None
+            self.snapshot_dir = None
+            self.current_etag = None
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+
+    # snapshots
+
+    def persist(self) -> int:
+        """
+        Writes a snapshot of the current rows (minus deleted sources) and the
+        staged rows, switches to it, and returns the number of rows
+        """
+        with self.lock:
+            deleted = set(self.read_json('deleted-sources.json', []))
+            staged_vectors, staged_lines = self.read_staging()
+            parts = []
+            lines = []
+            old = self.snapshot
+            if old is not None:
+                keep = []
+                for n in range(len(old['offsets'])):
+                    line = self.document_line(old, n)
+                    if json.loads(line)['metadata'].get('source') not in deleted:
+                        keep.append(n)
+                        lines.append(line)
+                if len(keep) > 0:
+                    parts.append(np.asarray(old['vectors'][keep], dtype=np.float32))
+            if len(staged_lines) > 0:
+                parts.append(staged_vectors)
+                lines.extend(staged_lines)
+
+            name = f'snapshot-{time.time_ns()}'
+            snapshot_dir = self.file(name)
+            os.makedirs(snapshot_dir)
+            vectors = np.concatenate(parts) if len(parts) > 0 else np.zeros((0, 0), dtype=np.float32)
+            np.save(os.path.join(snapshot_dir, 'vectors.npy'), vectors.astype(self.dtype))
+            offsets = []
+            with open(os.path.join(snapshot_dir, 'docs.jsonl'), 'w', encoding='utf-8') as f:
+                for line in lines:
+                    offsets.append(f.tell())
+                    f.write(line)
+            np.save(os.path.join(snapshot_dir, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+            if len(vectors) >= ivf_min_rows:
+                self.build_ivf(snapshot_dir, vectors)
+            if os.path.isfile(self.file('ingest-index.json')):
+                shutil.copy(self.file('ingest-index.json'), os.path.join(snapshot_dir, 'ingest-index.json'))
+
+            self.switch_to(name)
+            self.clear_staging()
+            logger.info(f'persisted snapshot {name} with {len(vectors)} vectors')
+        if self.s3_uri:
+            self.upload(snapshot_dir, name)
+        return len(vectors)
+
+    def build_ivf(self, snapshot_dir: str, vectors: np.ndarray) -> None:
+        n_lists = int(np.sqrt(len(vectors)))
+        centroids = kmeans(vectors, n_lists)
+        assignment = np.concatenate([
+            np.argmax(vectors[i:i+search_block_rows] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), search_block_rows)
+        ])
+        lists = np.argsort(assignment, kind='stable').astype(np.int32)
+        list_offsets = np.searchsorted(assignment[lists], np.arange(n_lists + 1)).astype(np.int64)
+        np.save(os.path.join(snapshot_dir, 'centroids.npy'), centroids.astype(np.float32))
+        np.save(os.path.join(snapshot_dir, 'lists.npy'), lists)
+        np.save(os.path.join(snapshot_dir, 'list_offsets.npy'), list_offsets)
+
+    def switch_to(self, name: str) -> None:
+        # swap the symlink so that readers see either the old or the new snapshot
+        link = self.file('current.tmp')
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(name, link)
+        os.replace(link, self.file('current'))
+        self.snapshot = self.open_snapshot(self.file(name))
+        self.snapshot_dir = os.path.realpath(self.file(name))
+        for entry in os.listdir(self.path):
+            if entry.startswith('snapshot-') and entry != name:
+                shutil.rmtree(self.file(entry), ignore_errors=True)
+
+    def open_snapshot(self, snapshot_dir: str) -> Optional[dict]:
+        vectors = np.load(os.path.join(snapshot_dir, 'vectors.npy'), mmap_mode='r')
+        if len(vectors) == 0:
+            return None
+        with open(os.path.join(snapshot_dir, 'docs.jsonl'), 'rb') as f:
+            docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        snapshot = {
+            'vectors': vectors,
+            'offsets': np.load(os.path.join(snapshot_dir, 'offsets.npy'), mmap_mode='r'),
+            'docs': docs,
+            'centroids': None,
+        }
+        if os.path.isfile(os.path.join(snapshot_dir, 'centroids.npy')):
+            snapshot['centroids'] = np.load(os.path.join(snapshot_dir, 'centroids.npy'))
+            snapshot['lists'] = np.load(os.path.join(snapshot_dir, 'lists.npy'), mmap_mode='r')
+            snapshot['list_offsets'] = np.load(os.path.join(snapshot_dir, 'list_offsets.npy'))
+        return snapshot
+
+    def load(self) -> None:
+        """
+        Opens the current snapshot, downloading a newer one from S3 first if
+        s3_uri is set - the open snapshot is kept if it is still current
+        """
+        if self.s3_uri:
+            try:
+                self.download()
+            except Exception as e:
+                logger.warning(f'could not download snapshot from {self.s3_uri}: {e}')
+        with self.lock:
+            current = os.path.realpath(self.file('current')) if os.path.isdir(self.file('current')) else None
+            if current == self.snapshot_dir:
+                return
+            self.snapshot = self.open_snapshot(current) if current is not None else None
+            self.snapshot_dir = current
+
+    def s3_location(self) -> Tuple[Any, str, str]:
+        import boto3
+        url = urlparse(self.s3_uri)
+        prefix = url.path.strip('/')
+        if prefix != '':
+            prefix += '/'
+        return boto3.session.Session().client(service_name='s3'), url.netloc, prefix
+
+    def upload(self, snapshot_dir: str, name: str) -> None:
+        client, bucket, prefix = self.s3_location()
+        for f in os.listdir(snapshot_dir):
+            client.upload_file(os.path.join(snapshot_dir, f), bucket, f'{prefix}{name}/{f}')
+        # written last so that replicas never see a partial snapshot
+        client.put_object(Bucket=bucket, Key=f'{prefix}CURRENT', Body=name.encode('utf-8'))
+        logger.info(f'uploaded snapshot {name} to {self.s3_uri}')
+
+    def download(self) -> None:
+        from botocore.exceptions import ClientError
+        client, bucket, prefix = self.s3_location()
+        # CURRENT is only read again if it changed since the last download
+        condition = {'IfNoneMatch': self.current_etag} if self.current_etag is not None else {}
+        try:
+            response = client.get_object(Bucket=bucket, Key=f'{prefix}CURRENT', **condition)
+        except client.exceptions.NoSuchKey:
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return
+            raise
+        name = response['Body'].read().decode('utf-8').strip()
+        if os.path.isdir(self.file('current')) and os.path.basename(os.path.realpath(self.file('current'))) == name:
+            self.current_etag = response['ETag']
+            return
+        tmp = self.file(name + '.download')
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}{name}/'):
+            for entry in page.get('Contents', []):
+                client.download_file(bucket, entry['Key'], os.path.join(tmp, os.path.basename(entry['Key'])))
+        with self.lock:
+            # e.g. CURRENT was rolled back to an older snapshot that is still
+            # here - the download replaces it, it may be incomplete
+            if os.path.isdir(self.file(name)):
+                shutil.rmtree(self.file(name))
+            os.replace(tmp, self.file(name))
+            if not os.path.isfile(self.file('ingest-index.json')) and os.path.isfile(os.path.join(self.file(name), 'ingest-index.json')):
+                shutil.copy(os.path.join(self.file(name), 'ingest-index.json'), self.file('ingest-index.json'))
+            self.switch_to(name)
+            self.current_etag = response['ETag']
+        logger.info(f'downloaded snapshot {name} from {self.s3_uri}')
+
+    # search
+
+    def document_line(self, snapshot: dict, n: int) -> str:
+        start = int(snapshot['offsets'][n])
+        end = snapshot['docs'].find(b'\n', start)
+        return snapshot['docs'][start:end + 1 if end != -1 else len(snapshot['docs'])].decode('utf-8')
+
+    def document(self, snapshot: dict, n: int) -> Document:
+        record = json.loads(self.document_line(snapshot, n))
+        return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        snapshot = self.snapshot
+        if snapshot is None:
+            return []
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        if snapshot['centroids'] is not None:
+            probe = np.argsort(-(snapshot['centroids'] @ query))[:ivf_nprobe]
+            list_offsets = snapshot['list_offsets']
+            rows = np.concatenate([snapshot['lists'][list_offsets[c]:list_offsets[c + 1]] for c in probe])
+            scores = np.asarray(snapshot['vectors'][np.sort(rows)], dtype=np.float32) @ query
+            rows = np.sort(rows)
+        else:
+            vectors = snapshot['vectors']
+            scores = np.concatenate([
+                np.asarray(vectors[i:i+search_block_rows], dtype=np.float32) @ query
+                for i in range(0, len(vectors), search_block_rows)
+            ])
+            rows = np.arange(len(vectors))
+        k = min(k, len(rows))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.document(snapshot, int(rows[i])), float(scores[i])) for i in top]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_by_vectors(self, embeddings: List[List[float]], k: int = 4) -> List[List[Document]]:
+        """
+        Searches for several query vectors at once - a brute-force search
+        reads the vectors once for all of them
+        """
+        snapshot = self.snapshot
+        if snapshot is None or len(embeddings) == 0:
+            return [[] for _ in embeddings]
+        if snapshot['centroids'] is not None:
+            return [self.similarity_search_by_vector(e, k) for e in embeddings]
+        queries = normalize(np.asarray(embeddings, dtype=np.float32))
+        vectors = snapshot['vectors']
+        # the best k rows of each block for each query
+        block_rows = []
+        block_scores = []
+        for i in range(0, len(vectors), search_block_rows):
+            scores = np.asarray(vectors[i:i+search_block_rows], dtype=np.float32) @ queries.T
+            n = min(k, len(scores))
+            top = np.argpartition(-scores, n - 1, axis=0)[:n]
+            block_rows.append(top + i)
+            block_scores.append(np.take_along_axis(scores, top, axis=0))
+        rows = np.concatenate(block_rows)
+        scores = np.concatenate(block_scores)
+        results = []
+        for q in range(len(queries)):
+            best = np.argsort(-scores[:, q])[:k]
+            results.append([self.document(snapshot, int(rows[j, q])) for j in best])
+        return results
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        # scores are cosine similarities
+        return lambda score: score
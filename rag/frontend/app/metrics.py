@@ -0,0 +1,67 @@
+import time
+import contextlib
+from typing import Iterator, List, Optional
+from prometheus_client import Counter, Gauge, Histogram
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# spans are recorded if opentelemetry is installed and an SDK is configured
+# (e.g. with opentelemetry-instrument), the API is a no-op otherwise
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer('rag')
+except ImportError:
+    tracer = None
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+query_stage_seconds = Histogram('rag_query_stage_seconds', 'Time spent in each stage of a query (embed_query and vector_search per batch of queries, retrieve, keyword_search, rerank)', ['stage'], buckets=latency_buckets)
+query_seconds = Histogram('rag_query_seconds', 'Time from receiving a query to sending the last source', buckets=latency_buckets)
+time_to_first_token_seconds = Histogram('rag_time_to_first_token_seconds', 'Time from receiving a query to streaming the first token', buckets=latency_buckets)
+tokens_per_second = Histogram('rag_llm_tokens_per_second', 'Rate at which the LLM streams tokens after the first one', buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500))
+queries_total = Counter('rag_queries_total', 'Queries by result (answered, cached, error, rejected)', ['result'])
+queries_in_flight = Gauge('rag_queries_in_flight', 'Queries that are being answered')
+queries_queued = Gauge('rag_queries_queued', 'Queries waiting for admission')
+answer_cache_requests_total = Counter('rag_answer_cache_requests_total', 'Answer cache lookups by result (hit, miss)', ['result'])
+retrieval_cache_requests_total = Counter('rag_retrieval_cache_requests_total', 'Retrieval cache lookups by result (hit, miss)', ['result'])
+retrieval_batch_size = Histogram('rag_retrieval_batch_size', 'Distinct queries embedded and searched together', buckets=(1, 2, 4, 8, 16, 32, 64))
+
+ingest_stage_seconds = Histogram('rag_ingest_stage_seconds', 'Time spent on one item (a file, or a batch for embed) in each ingestion stage', ['stage'], buckets=latency_buckets)
+ingest_files_total = Counter('rag_ingest_files_total', 'Files that completed each ingestion stage', ['stage'])
+ingest_documents_total = Counter('rag_ingest_documents_total', 'Documents (e.g. PDF pages) produced by the loaders')
+ingest_chunks_total = Counter('rag_ingest_chunks_total', 'Chunks that completed each ingestion stage (split, embed)', ['stage'])
+ingest_bytes_total = Counter('rag_ingest_bytes_total', 'Bytes downloaded from the source bucket')
+
+
+@contextlib.contextmanager
+def span(name: str, histogram: Optional[Histogram] = None, **attributes) -> Iterator[None]:
+    """
+    Records the duration of the block in histogram and, if tracing is
+    enabled, as a span
+    """
+    start = time.perf_counter()
+    current = tracer.start_as_current_span(name, attributes=attributes) if tracer is not None else contextlib.nullcontext()
+    try:
+        with current:
+            yield
+    finally:
+        if histogram is not None:
+            histogram.observe(time.perf_counter() - start)
+
+
+class TimedRetriever(BaseRetriever):
+    """
+    Records the time taken by another retriever as a query stage
+    """
+
+    retriever: BaseRetriever
+    stage: str
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with span(self.stage, query_stage_seconds.labels(self.stage)):
+            return self.retriever.invoke(query, config={'callbacks': run_manager.get_child()})
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        with span(self.stage, query_stage_seconds.labels(self.stage)):
+            return await self.retriever.ainvoke(query, config={'callbacks': run_manager.get_child()})
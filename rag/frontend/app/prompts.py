@@ -0,0 +1,102 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# the same for every prompt, so vLLM's prefix cache always has it
+system_prefix = "Use the following pieces of context to answer the questions. If you don't know the answer, just say that you don't know, don't try to make up an answer."
+
+
+def canonical_order(documents: Sequence[Document]) -> List[Document]:
+    """
+    Sorts documents by source, page and contents, so that queries that
+    retrieve the same documents send the same prompt whatever their ranks
+    """
+    def key(doc: Document):
+        page = doc.metadata.get('page')
+        return (str(doc.metadata.get('source', '')), page if isinstance(page, int) else -1, doc.page_content)
+    return sorted(documents, key=key)
+
+
+def render_turn(contexts: List[str], question: str) -> str:
+    turn = ''
+    if len(contexts) > 0:
+        turn += 'Context:\n' + '\n\n'.join(contexts) + '\n\n'
+    return turn + f'Question: {question}\nHelpful Answer:'
+
+
+class Session:
+    """
+    The prompt of a conversation so far - every turn appends the contexts
+    that are not in the prompt yet, the question and the answer, so the
+    prompt of a turn starts with the prompt and answer of the previous turn
+    and vLLM reuses their KV cache
+    """
+
+    def __init__(self, transcript: str = '', contexts: Optional[set] = None) -> None:
+        self.transcript = transcript
+        self.contexts = contexts if contexts is not None else set()
+
+    def is_new(self) -> bool:
+        return self.transcript == ''
+
+    def next_turn(self, contexts: List[str], question: str) -> Tuple[str, 'Session']:
+        """
+        Returns the prompt for the question and the session with this turn,
+        that answered() completes
+        """
+        new = []
+        for c in contexts:
+            if c not in self.contexts and c not in new:
+                new.append(c)
+        prompt = (self.transcript or system_prefix + '\n\n') + render_turn(new, question)
+        return prompt, Session(prompt, self.contexts | set(new))
+
+    def answered(self, answer: str) -> None:
+        self.transcript += answer + '\n\n'
+
+
+class SessionStore:
+    """
+    LRU of sessions keyed on the session ID sent by the client
+    """
+
+    def __init__(self, max_sessions: int, ttl: float) -> None:
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # session ID -> (expiry time, session)
+        self.entries = OrderedDict()
+
+    def enabled(self) -> bool:
+        return self.max_sessions > 0
+
+    def get(self, session_id: Optional[str]) -> Optional[Session]:
+        """
+        Returns the session, a new one if it expired, or None if sessions
+        are disabled or session_id is not set
+        """
+        if not self.enabled() or not session_id:
+            return None
+        now = time.monotonic()
+        for key in [k for k, (expiry, _) in self.entries.items() if expiry < now]:
+            del self.entries[key]
+        if session_id not in self.entries:
+            return Session()
+        self.entries.move_to_end(session_id)
+        return self.entries[session_id][1]
+
+    def save(self, session_id: Optional[str], session: Session) -> None:
+        if not self.enabled() or not session_id:
+            return
+        self.entries[session_id] = (time.monotonic() + self.ttl, session)
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > self.max_sessions:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        if len(self.entries) > 0:
+            logger.info(f'clearing {len(self.entries)} sessions')
+        self.entries.clear()
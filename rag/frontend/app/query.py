@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
-from langchain.chains import RetrievalQA
 from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import CrossEncoderReranker
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.retrievers.document_compressors import DocumentCompressorPipeline
 from langchain_openai import OpenAI
+import httpx
 
 import logging
 import sys
 import json
 import os
-from typing import AsyncIterable, Any
+import time
+from typing import AsyncIterable, Any, List, Optional
 import asyncio
-from db import get_db_connection
+from db import get_db_connection, embeddings, sync_sparse_index
+from cache import AnswerCache
+from rerank import RerankService, BatchedCrossEncoderReranker
+from sparse import HybridRetriever, sparse_index
+from streaming import TokenStream
+from chunking import ContextPacker, count_tokens
+from retrieval import RetrievalService, BatchedRetriever
+from prompts import Session, SessionStore, canonical_order, render_turn, system_prefix
+from metrics import span, TimedRetriever, query_seconds, time_to_first_token_seconds, tokens_per_second, queries_total, queries_in_flight, answer_cache_requests_total
 
 llm_stop_sequences = ['Question: ']
 
@@ -29,9 +36,51 @@ reranker_model_name = os.environ.get("RERANKER_MODEL_NAME", "BAAI/bge-reranker-b
 openai_api_base = os.environ.get("OPENAI_API_BASE", "http://localhost:8080/v1")
 openai_api_key = os.environ.get("OPENAI_API_KEY", "EMPTY")
 target_source_chunks = int(os.environ.get('TARGET_SOURCE_CHUNKS',4))
+# with the reranker, more candidates are retrieved and the best ones are kept
+rerank_fetch_k = int(os.environ.get('RERANK_FETCH_K', 32))
+rerank_top_n = int(os.environ.get('RERANK_TOP_N', 3))
+
+# connection pool shared by all requests to the LLM
+llm_max_connections = int(os.environ.get('LLM_MAX_CONNECTIONS', 100))
+llm_max_keepalive_connections = int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 20))
+llm_keepalive_expiry = float(os.environ.get('LLM_KEEPALIVE_EXPIRY', 60))
+llm_connect_timeout = float(os.environ.get('LLM_CONNECT_TIMEOUT', 10))
+llm_read_timeout = float(os.environ.get('LLM_READ_TIMEOUT', 300))
+
+# tokens generated per answer, and the model's context window - the retrieved
+# documents are trimmed to fit in what is left, or in context_token_budget
+# tokens if that is smaller (0 for no limit)
+llm_max_tokens = int(os.environ.get('LLM_MAX_TOKENS', 256))
+llm_context_window = int(os.environ.get('LLM_CONTEXT_WINDOW', 4096))
+context_token_budget = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 0))
+
+# tokens are sent to the client in chunks of up to stream_coalesce_chars
+# characters, held back for at most stream_coalesce_delay
+stream_coalesce_delay = float(os.environ.get('STREAM_COALESCE_MS', 50)) / 1000
+stream_coalesce_chars = int(os.environ.get('STREAM_COALESCE_CHARS', 256))
+# tokens buffered for a slow client before reading from the LLM is paused
+stream_queue_size = int(os.environ.get('STREAM_QUEUE_SIZE', 256))
+# keeps the connection open while the query is retrieving or waiting for the LLM
+ping_interval = 5
+
+# answers to repeated (or, above the similarity threshold, similar) prompts
+# are replayed from the cache - set ANSWER_CACHE_SIZE to 0 to disable
+answer_cache_size = int(os.environ.get('ANSWER_CACHE_SIZE', 256))
+answer_cache_ttl = float(os.environ.get('ANSWER_CACHE_TTL', 3600))
+answer_cache_similarity = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.95))
+
+# conversations that follow-up questions with a session_id continue - set
+# MAX_SESSIONS to 0 to answer every question on its own
+max_sessions = int(os.environ.get('MAX_SESSIONS', 1000))
+session_ttl = float(os.environ.get('SESSION_TTL', 1800))
 
 retriever = None
 llm = None
+rerank_service = None
+# query embeddings and vector searches of concurrent requests are batched
+retrieval_service = RetrievalService(embeddings)
+answer_cache = AnswerCache(answer_cache_size, answer_cache_ttl, answer_cache_similarity, retrieval_service.embed)
+sessions = SessionStore(max_sessions, session_ttl)
 
 
 def parse_boolean_environent_variable(key: str, default=False) -> bool:
@@ -46,73 +95,172 @@ def parse_boolean_environent_variable(key: str, default=False) -> bool:
         val = True
     return val
 
-def initialize_query_engine():
-    global retriever
-
-    db = get_db_connection()
-    db_retriever = db.as_retriever(search_kwargs={"k": target_source_chunks})
-    retriever = db_retriever
-
-    if parse_boolean_environent_variable('USE_RERANKER'):
-        logger.info('using reranker')
-        reranker_model = HuggingFaceCrossEncoder(model_name=reranker_model_name)
-        compressor = CrossEncoderReranker(model=reranker_model, top_n=3)
-        retriever = ContextualCompressionRetriever(
-            base_compressor=compressor, base_retriever=db_retriever
-        )
-    else:
-        logger.info('not using reranker')
-
-async def llm_query(prompt: str) -> AsyncIterable[str]:
-    callback = AsyncIteratorCallbackHandler()
-    llm = OpenAI(
+def create_llm() -> OpenAI:
+    limits = httpx.Limits(
+        max_connections=llm_max_connections,
+        max_keepalive_connections=llm_max_keepalive_connections,
+        keepalive_expiry=llm_keepalive_expiry
+    )
+    timeout = httpx.Timeout(llm_read_timeout, connect=llm_connect_timeout)
+    return OpenAI(
         model_name=model,
         model_kwargs={"stop": llm_stop_sequences},
+        max_tokens=llm_max_tokens,
         openai_api_base=openai_api_base,
         openai_api_key=openai_api_key,
-        callbacks=[callback],
+        http_client=httpx.Client(limits=limits, timeout=timeout),
+        http_async_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+        request_timeout=timeout,
         temperature=0,
         streaming=True
     )
 
-    async def send_llm_request():
+def initialize_query_engine():
+    global retriever, llm, rerank_service
+
+    db = get_db_connection()
+    use_reranker = parse_boolean_environent_variable('USE_RERANKER')
+    k = rerank_fetch_k if use_reranker else target_source_chunks
+    retrieval_service.configure(db, k)
+    db_retriever = TimedRetriever(retriever=BatchedRetriever(service=retrieval_service), stage='retrieve')
+
+    use_hybrid_search = parse_boolean_environent_variable('USE_HYBRID_SEARCH', True)
+    if use_hybrid_search:
+        # e.g. the pod was rescheduled, or another replica ingested files
         try:
-            res = await qa.ainvoke({'query': prompt})
-            return res
+            sync_sparse_index(sparse_index)
         except Exception as e:
-            raise e
-        finally:
-            callback.done
-
-    qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever, return_source_documents=True)
-    task = asyncio.create_task(send_llm_request())
-
-    async def ping_producer(queue, long_running):
-        while True:
-            await asyncio.wait([long_running], timeout=5)
-            if long_running.done():
-                break
-            await queue.put({'ping': True})
-
-    async def llm_producer(queue):
-        async for token in callback.aiter():
-            await queue.put({'text': token})
-        await queue.put(None)
-
-    queue = asyncio.Queue()
-    llm_future = asyncio.create_task(llm_producer(queue))
-    ping_future = asyncio.create_task(ping_producer(queue, llm_future))
-    while True:
-        item = await queue.get()
-        queue.task_done()
-        if item is None:
-            break
-        yield json.dumps(item) + '\n'
-    await ping_future
-    
-    await task
+            logger.warning(f'could not rebuild the keyword index: {e}')
+    if use_hybrid_search and sparse_index.reload():
+        logger.info('using hybrid search')
+        db_retriever = HybridRetriever(dense=db_retriever, sparse=sparse_index, k=k)
+    else:
+        logger.info('not using hybrid search')
+    retriever = db_retriever
+
+    compressors = []
+    if use_reranker:
+        logger.info('using reranker')
+        # the model is loaded once and shared by all requests
+        if rerank_service is None:
+            rerank_service = RerankService(reranker_model_name)
+        compressors.append(BatchedCrossEncoderReranker(service=rerank_service, top_n=rerank_top_n))
+    else:
+        logger.info('not using reranker')
+    # the documents must fit in the context window with room for generation
+    compressors.append(ContextPacker(
+        max_prompt_tokens=llm_context_window - llm_max_tokens,
+        max_context_tokens=context_token_budget,
+        template_tokens=count_tokens(system_prefix + '\n\n' + render_turn([''], ''))
+    ))
+    retriever = ContextualCompressionRetriever(
+        base_compressor=compressors[0] if len(compressors) == 1 else DocumentCompressorPipeline(transformers=compressors),
+        base_retriever=db_retriever
+    )
+
+    # the LLM and its connection pool are long-lived, streaming callbacks
+    # are attached to each request instead
+    if llm is None:
+        llm = create_llm()
+    clear_caches()
+
+def clear_caches():
+    """
+    Forgets retrieved documents, answers and conversations, which may refer
+    to documents that changed
+    """
+    answer_cache.clear()
+    sessions.clear()
+    retrieval_service.clear()
+
+def warm_up_retriever():
+    initialize_query_engine()
+    # connects to the database and, if enabled, runs the reranker once
+    retriever.invoke('warm up')
+
+def check_llm():
+    response = httpx.get(f'{openai_api_base.rstrip("/")}/models', headers={'Authorization': f'Bearer {openai_api_key}'}, timeout=llm_connect_timeout)
+    response.raise_for_status()
+
+def build_prompt(session: Session, contexts: List[str], question: str) -> tuple:
+    """
+    Returns the prompt and the session with this turn - the conversation
+    starts over if the prompt would not fit in the context window
+    """
+    prompt, turn = session.next_turn(contexts, question)
+    if not session.is_new() and count_tokens(prompt) > llm_context_window - llm_max_tokens:
+        logger.info('conversation does not fit in the context window, starting over')
+        prompt, turn = Session().next_turn(contexts, question)
+    return prompt, turn
+
+async def generate(question: str, session: Session, callbacks: list) -> dict:
+    """
+    Retrieves documents for the question and generates the answer - the
+    prompt is the system prefix, the documents in canonical order and the
+    question, appended to the conversation so far
+    """
+    documents = canonical_order(await retriever.ainvoke(question, config={'callbacks': callbacks}))
+    prompt, turn = build_prompt(session, [d.page_content for d in documents], question)
+    answer = await llm.ainvoke(prompt, config={'callbacks': callbacks})
+    turn.answered(answer)
+    return {'result': answer, 'source_documents': documents, 'session': turn}
+
+async def llm_query(prompt: str, session_id: Optional[str] = None) -> AsyncIterable[str]:
+    queries_in_flight.inc()
+    try:
+        with span('llm_query'):
+            async for line in answer_query(prompt, session_id):
+                yield line
+    finally:
+        queries_in_flight.dec()
+
+async def answer_query(prompt: str, session_id: Optional[str] = None) -> AsyncIterable[str]:
+    start = time.perf_counter()
+    session = sessions.get(session_id)
+    # answers to follow-up questions depend on the conversation
+    use_cache = session is None or session.is_new()
+    if use_cache:
+        cached, prompt_vector = await answer_cache.lookup(prompt)
+        if cached is not None:
+            answer_cache_requests_total.labels('hit').inc()
+            queries_total.labels('cached').inc()
+            if session is not None:
+                # the cached sources are the contexts of the cached prompt
+                _, turn = build_prompt(session, [item['source']['contents'] for item in cached if 'source' in item], prompt)
+                turn.answered(''.join(item['text'] for item in cached if 'text' in item))
+                sessions.save(session_id, turn)
+            for item in cached:
+                yield json.dumps(item) + '\n'
+            return
+        if answer_cache.enabled():
+            answer_cache_requests_total.labels('miss').inc()
+
+    # everything but pings, so the answer can be replayed from the cache
+    items = []
+    stream = TokenStream(stream_queue_size)
+    task = asyncio.create_task(generate(prompt, session or Session(), [stream]))
+    try:
+        async for item in stream.items(task, stream_coalesce_delay, stream_coalesce_chars, ping_interval):
+            if 'ping' not in item:
+                items.append(item)
+            yield json.dumps(item) + '\n'
+    finally:
+        # the client disconnected or the response failed - cancelling the
+        # chain closes the connection to the LLM, which stops generating
+        if not task.done():
+            logger.info('cancelling LLM request')
+            task.cancel()
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    if stream.first_token is not None:
+        time_to_first_token_seconds.observe(stream.first_token - start)
+        if stream.tokens > 1 and stream.last_token > stream.first_token:
+            tokens_per_second.observe((stream.tokens - 1) / (stream.last_token - stream.first_token))
+
     if task.exception() is not None:
-        yield json.dumps({'error': task.exception()}) + '\n'
+        queries_total.labels('error').inc()
+        logger.error(f'query failed: {task.exception()!r}')
+        yield json.dumps({'error': f'{type(task.exception()).__name__}: {task.exception()}'}) + '\n'
     elif task.result() is not None and task.result().get("source_documents") is not None:
         for doc in task.result().get('source_documents'):
             path = doc.metadata['source'] # should set this to doc.metadata['file_path']
@@ -127,12 +275,17 @@ async def llm_query(prompt: str) -> AsyncIterable[str]:
             file_path = doc.metadata.get('file_path')
             if file_path is not None and (file_path.startswith('http://') or file_path.startswith('https://')):
                 obj['source']['url'] = file_path
+            items.append(obj)
             yield json.dumps(obj) + '\n'
+        if use_cache:
+            answer_cache.store(prompt, items, prompt_vector)
+        sessions.save(session_id, task.result()['session'])
+        queries_total.labels('answered').inc()
+        query_seconds.observe(time.perf_counter() - start)
 
 
-initialize_query_engine()
-
 async def main():
+    initialize_query_engine()
     async for token in llm_query('describe the dip switch settings for the 2-axis servo amplifier'):
         print(token)
 
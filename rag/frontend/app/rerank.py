@@ -0,0 +1,186 @@
+import os
+import time
+import queue
+import asyncio
+import hashlib
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+from embeddings import model_cache_dir
+from metrics import span, query_stage_seconds
+
+logger = logging.getLogger(__name__)
+
+# torch (sentence-transformers), onnx or onnx-int8 (CPU only)
+reranker_backend = os.environ.get("RERANKER_BACKEND", "torch")
+# 0 leaves the number of intra-op threads to the backend
+reranker_threads = int(os.environ.get("RERANKER_THREADS", 0))
+# pairs from concurrent requests that arrive within the window are scored together
+rerank_batch_window = float(os.environ.get("RERANK_BATCH_WINDOW_MS", 10)) / 1000
+rerank_max_batch = int(os.environ.get("RERANK_MAX_BATCH", 64))
+rerank_cache_size = int(os.environ.get("RERANK_CACHE_SIZE", 10000))
+
+
+class CrossEncoderBackend:
+    def __init__(self, model_name: str, threads: int) -> None:
+        import torch
+        from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model = HuggingFaceCrossEncoder(model_name=model_name)
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        return list(self.model.score(pairs))
+
+
+class OnnxCrossEncoderBackend:
+    def __init__(self, model_name: str, threads: int, quantize: bool) -> None:
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise Exception(f'the {reranker_backend} reranker backend needs optimum[onnxruntime]: {e}')
+
+        session_options = onnxruntime.SessionOptions()
+        if threads > 0:
+            session_options.intra_op_num_threads = threads
+        export_dir = os.path.join(model_cache_dir, model_name.replace('/', '--'))
+        if not os.path.isfile(os.path.join(export_dir, 'model.onnx')):
+            ORTModelForSequenceClassification.from_pretrained(model_name, export=True).save_pretrained(export_dir)
+        file_name = 'model.onnx'
+        if quantize:
+            if not os.path.isfile(os.path.join(export_dir, 'model_quantized.onnx')):
+                quantizer = ORTQuantizer.from_pretrained(export_dir)
+                quantizer.quantize(save_dir=export_dir, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+            file_name = 'model_quantized.onnx'
+        self.model = ORTModelForSequenceClassification.from_pretrained(export_dir, file_name=file_name, session_options=session_options)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        inputs = self.tokenizer([p[0] for p in pairs], [p[1] for p in pairs], padding=True, truncation=True, return_tensors='np')
+        logits = self.model(**inputs).logits
+        # same activation as sentence-transformers uses for single-label models
+        return (1 / (1 + np.exp(-logits[:, 0]))).tolist()
+
+
+class RerankService:
+    """
+    Scores (query, passage) pairs on a worker thread, batching the pairs of
+    concurrent requests together and caching the scores
+    """
+
+    def __init__(self, model_name: str, backend: str = reranker_backend, threads: int = reranker_threads, batch_window: float = rerank_batch_window, max_batch: int = rerank_max_batch, cache_size: int = rerank_cache_size) -> None:
+        if backend == 'torch':
+            self.backend = CrossEncoderBackend(model_name, threads)
+        elif backend in ('onnx', 'onnx-int8'):
+            self.backend = OnnxCrossEncoderBackend(model_name, threads, backend == 'onnx-int8')
+        else:
+            raise Exception(f'unknown reranker backend {backend}')
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, name='rerank', daemon=True).start()
+        logger.info(f'reranker model {model_name}, backend {backend}, batch window {batch_window * 1000}ms')
+
+    def cache_key(self, query: str, passage: str) -> str:
+        return hashlib.sha256(f'{query}\0{passage}'.encode('utf-8')).hexdigest()
+
+    def run(self) -> None:
+        while True:
+            batch = [self.requests.get()]
+            pairs = len(batch[0][0])
+            deadline = time.monotonic() + self.batch_window
+            while pairs < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                pairs += len(batch[-1][0])
+            try:
+                scores = self.backend.score([pair for request_pairs, _ in batch for pair in request_pairs])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            i = 0
+            for request_pairs, future in batch:
+                future.set_result(scores[i:i+len(request_pairs)])
+                i += len(request_pairs)
+
+    def submit(self, query: str, passages: List[str]) -> concurrent.futures.Future:
+        result = concurrent.futures.Future()
+        keys = [self.cache_key(query, p) for p in passages]
+        with self.cache_lock:
+            scores = [self.cache.get(k) for k in keys]
+            for k, s in zip(keys, scores):
+                if s is not None:
+                    self.cache.move_to_end(k)
+        missing = [i for i, s in enumerate(scores) if s is None]
+        if len(missing) == 0:
+            result.set_result(scores)
+            return result
+
+        def done(future: concurrent.futures.Future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+            with self.cache_lock:
+                for i, s in zip(missing, future.result()):
+                    scores[i] = s
+                    self.cache[keys[i]] = s
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            result.set_result(scores)
+
+        scored = concurrent.futures.Future()
+        scored.add_done_callback(done)
+        self.requests.put(([(query, passages[i]) for i in missing], scored))
+        return result
+
+    def score(self, query: str, passages: List[str]) -> List[float]:
+        return self.submit(query, passages).result()
+
+    async def ascore(self, query: str, passages: List[str]) -> List[float]:
+        return await asyncio.wrap_future(self.submit(query, passages))
+
+
+class BatchedCrossEncoderReranker(BaseDocumentCompressor):
+    """
+    Keeps the top_n documents ranked by a RerankService
+    """
+
+    service: RerankService
+    top_n: int = 3
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def select(self, documents: Sequence[Document], scores: List[float]) -> Sequence[Document]:
+        ranked = sorted(zip(documents, scores), key=lambda t: t[1], reverse=True)
+        return [doc for doc, _ in ranked[:self.top_n]]
+
+    def compress_documents(self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None) -> Sequence[Document]:
+        if len(documents) == 0:
+            return []
+        with span('rerank', query_stage_seconds.labels('rerank'), documents=len(documents)):
+            return self.select(documents, self.service.score(query, [d.page_content for d in documents]))
+
+    async def acompress_documents(self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None) -> Sequence[Document]:
+        if len(documents) == 0:
+            return []
+        with span('rerank', query_stage_seconds.labels('rerank'), documents=len(documents)):
+            return self.select(documents, await self.service.ascore(query, [d.page_content for d in documents]))
@@ -0,0 +1,180 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from typing import List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from cache import normalize_prompt
+from db import search_by_vectors
+from embeddings import CachedEmbeddings
+from metrics import span, query_stage_seconds, retrieval_cache_requests_total, retrieval_batch_size
+
+logger = logging.getLogger(__name__)
+
+# queries from concurrent requests that arrive within the window are
+# embedded and searched together
+retrieval_batch_window = float(os.environ.get("RETRIEVAL_BATCH_WINDOW_MS", 5)) / 1000
+retrieval_max_batch = int(os.environ.get("RETRIEVAL_MAX_BATCH", 32))
+# retrieved chunks by normalized query - set to 0 to disable
+retrieval_cache_size = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 1000))
+
+
+class RetrievalService:
+    """
+    Embeds queries and searches the vector store on a worker thread, batching
+    the queries of concurrent requests together, and caches the chunks
+    retrieved for each normalized query until clear() is called. configure()
+    must be called before the first search
+    """
+
+    def __init__(self, embeddings: CachedEmbeddings, batch_window: float = retrieval_batch_window, max_batch: int = retrieval_max_batch, cache_size: int = retrieval_cache_size) -> None:
+        self.embeddings = embeddings
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.db = None
+        self.k = 4
+        self.cache = OrderedDict()
+        # incremented when the cache is cleared
+        self.generation = 0
+        self.cache_lock = threading.Lock()
+        # vectors of embed() requests by the embedded text, so that a search
+        # for the same text does not embed it again - the answer cache embeds
+        # the normalized prompt, which is only reused if the query is the same
+        self.vectors = OrderedDict()
+        self.vectors_size = 4 * max_batch
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, name='retrieval', daemon=True).start()
+        logger.info(f'retrieval batch window {batch_window * 1000}ms, cache size {cache_size}')
+
+    def configure(self, db: VectorStore, k: int) -> None:
+        with self.cache_lock:
+            self.db = db
+            self.k = k
+            self.cache.clear()
+            self.generation += 1
+
+    def clear(self) -> None:
+        with self.cache_lock:
+            if len(self.cache) > 0:
+                logger.info(f'clearing {len(self.cache)} cached retrievals')
+            self.cache.clear()
+            self.generation += 1
+
+    def run(self) -> None:
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            with self.cache_lock:
+                db, k, generation = self.db, self.k, self.generation
+                known = {query: self.vectors[query] for _, query, _, _ in batch if query in self.vectors}
+            # identical queries in the batch are only embedded and searched once
+            texts = list(dict.fromkeys(query for _, query, _, _ in batch if query not in known))
+            searched = list(dict.fromkeys(query for _, query, search, _ in batch if search))
+            retrieval_batch_size.observe(len(dict.fromkeys(query for _, query, _, _ in batch)))
+            try:
+                embedded = {}
+                if len(texts) > 0:
+                    with span('embed_query', query_stage_seconds.labels('embed_query'), queries=len(texts)):
+                        embedded = dict(zip(texts, self.embeddings.embed_queries(texts)))
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            vectors = {}
+            for _, query, _, _ in batch:
+                vectors.setdefault(query, known[query] if query in known else embedded[query])
+            with self.cache_lock:
+                for _, query, search, _ in batch:
+                    if not search:
+                        self.vectors[query] = vectors[query]
+                        self.vectors.move_to_end(query)
+                while len(self.vectors) > self.vectors_size:
+                    self.vectors.popitem(last=False)
+            results = {}
+            error = None
+            if len(searched) > 0:
+                try:
+                    with span('vector_search', query_stage_seconds.labels('vector_search'), queries=len(searched)):
+                        results = dict(zip(searched, search_by_vectors(db, [vectors[query] for query in searched], k)))
+                except Exception as e:
+                    error = e
+            with self.cache_lock:
+                # results of a search that started before the cache was cleared are not cached
+                if self.cache_size > 0 and generation == self.generation:
+                    for key, query, search, _ in batch:
+                        if search and query in results:
+                            self.cache[key] = results[query]
+                            self.cache.move_to_end(key)
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            for _, query, search, future in batch:
+                if not search:
+                    future.set_result(vectors[query])
+                elif error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(list(results[query]))
+
+    def submit(self, query: str) -> concurrent.futures.Future:
+        result = concurrent.futures.Future()
+        key = normalize_prompt(query)
+        with self.cache_lock:
+            documents = self.cache.get(key)
+            if documents is not None:
+                self.cache.move_to_end(key)
+        if documents is not None:
+            retrieval_cache_requests_total.labels('hit').inc()
+            result.set_result(list(documents))
+            return result
+        if self.cache_size > 0:
+            retrieval_cache_requests_total.labels('miss').inc()
+        self.requests.put((key, query, True, result))
+        return result
+
+    def retrieve(self, query: str) -> List[Document]:
+        return self.submit(query).result()
+
+    async def aretrieve(self, query: str) -> List[Document]:
+        return await asyncio.wrap_future(self.submit(query))
+
+    def embed(self, query: str) -> List[float]:
+        """
+        Embeds the query in a batch with the queries of concurrent requests -
+        a search for exactly the same text reuses the vector
+        """
+        result = concurrent.futures.Future()
+        self.requests.put((normalize_prompt(query), query, False, result))
+        return result.result()
+
+
+class BatchedRetriever(BaseRetriever):
+    """
+    Retrieves documents through a RetrievalService
+    """
+
+    service: RetrievalService
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.service.retrieve(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return await self.service.aretrieve(query)
@@ -0,0 +1,317 @@
+import os
+import re
+import json
+import hashlib
+import mmap
+import time
+import shutil
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Iterable, List, Optional
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from metrics import span, query_stage_seconds
+
+logger = logging.getLogger(__name__)
+
+sparse_index_dir = os.environ.get("SPARSE_INDEX_DIR", os.path.join(os.environ.get("TMPDIR", "/tmp"), "sparse-index"))
+
+# BM25 parameters
+k1 = 1.2
+b = 0.75
+
+# keeps part numbers and model codes (e.g. MR-J4-10A, 2-axis) together
+token_pattern = re.compile(r'[a-z0-9]+(?:[-_./][a-z0-9]+)*')
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in token_pattern.findall(text.lower()):
+        tokens.append(token)
+        # also index the parts of compound tokens
+        parts = re.split(r'[-_./]', token)
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if p != '')
+    return tokens
+
+
+def chunk_key(doc: Document) -> str:
+    return f"{doc.metadata.get('source', '')}\0{doc.page_content}"
+
+
+def ingest_index_fingerprint(ingest_index: dict) -> str:
+    return hashlib.sha256(json.dumps(ingest_index, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SparseIndex:
+    """
+    BM25 index over the ingested chunks. Chunks are appended to chunks.jsonl
+    during ingestion, and build() writes the inverted index as numpy arrays
+    that are memory-mapped by the query path:
+
+        vocab.json      term -> [start, end] range in postings
+        postings.npy    chunk numbers (int32), grouped by term
+        tfs.npy         term frequencies (uint16), parallel to postings
+        doclen.npy      number of tokens of each chunk (int32)
+        offsets.npy     offset of each chunk in docs.jsonl (int64)
+        docs.jsonl      page content and metadata of each chunk
+
+    The index is on the pod's filesystem, while the ingest index that
+    decides which files are ingested again is in the database - built.json
+    records the ingest index that the chunks correspond to, so that an index
+    that is missing or out of date can be rebuilt from the database
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = None
+
+    def chunks_path(self) -> str:
+        return os.path.join(self.path, 'chunks.jsonl')
+
+    def current_path(self) -> str:
+        return os.path.join(self.path, 'current')
+
+    def built_path(self) -> str:
+        return os.path.join(self.path, 'built.json')
+
+    def built_for(self, ingest_index: dict) -> bool:
+        """
+        Whether the chunks are those of the files in ingest_index - they are
+        not on a new pod, or after another replica ingested files
+        """
+        try:
+            with open(self.built_path(), encoding='utf-8') as f:
+                return json.load(f).get('ingest_index') == ingest_index_fingerprint(ingest_index)
+        except (OSError, ValueError):
+            return False
+
+    def mark_built_for(self, ingest_index: dict) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.built_path() + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'ingest_index': ingest_index_fingerprint(ingest_index)}, f)
+        os.replace(tmp, self.built_path())
+
+    def rebuild(self, batches: Iterable[List[Document]], ingest_index: dict) -> int:
+        """
+        Replaces the chunks with the given ones (all chunks in the database)
+        and builds the index for ingest_index - returns the number of chunks
+        """
+        os.makedirs(self.path, exist_ok=True)
+        tmp = f'{self.chunks_path()}.{time.time_ns()}'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for documents in batches:
+                for doc in documents:
+                    f.write(json.dumps({'page_content': doc.page_content, 'metadata': doc.metadata}) + '\n')
+        with self.lock:
+            os.replace(tmp, self.chunks_path())
+        chunks = self.build()
+        self.mark_built_for(ingest_index)
+        return chunks
+
+    def add(self, documents: List[Document]) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock, open(self.chunks_path(), 'a', encoding='utf-8') as f:
+            for doc in documents:
+                f.write(json.dumps({'page_content': doc.page_content, 'metadata': doc.metadata}) + '\n')
+
+    def delete_sources(self, sources: List[str]) -> None:
+        if len(sources) == 0 or not os.path.isfile(self.chunks_path()):
+            return
+        sources = set(sources)
+        tmp = self.chunks_path() + '.tmp'
+        with self.lock:
+            with open(self.chunks_path(), encoding='utf-8') as src, open(tmp, 'w', encoding='utf-8') as dst:
+                for line in src:
+                    if json.loads(line)['metadata'].get('source') not in sources:
+                        dst.write(line)
+            os.replace(tmp, self.chunks_path())
+
+    def sources(self) -> set:
+        if not os.path.isfile(self.chunks_path()):
+            return set()
+        with self.lock, open(self.chunks_path(), encoding='utf-8') as f:
+            return {json.loads(line)['metadata'].get('source') for line in f}
+
+    def replace_sources(self, sources: List[str], staged: 'SparseIndex') -> None:
+        """
+        Replaces the chunks of sources, and of every source that has chunks
+        in staged, with the chunks in staged, and clears staged
+        """
+        sources = set(sources) | staged.sources()
+        if len(sources) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.chunks_path() + '.tmp'
+        with self.lock:
+            with open(tmp, 'w', encoding='utf-8') as dst:
+                if os.path.isfile(self.chunks_path()):
+                    with open(self.chunks_path(), encoding='utf-8') as src:
+                        for line in src:
+                            if json.loads(line)['metadata'].get('source') not in sources:
+                                dst.write(line)
+                if os.path.isfile(staged.chunks_path()):
+                    with open(staged.chunks_path(), encoding='utf-8') as src:
+                        shutil.copyfileobj(src, dst)
+            os.replace(tmp, self.chunks_path())
+        staged.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.loaded = None
+
+    def build(self) -> int:
+        """
+        Rebuilds the index from chunks.jsonl and atomically replaces the
+        current one - returns the number of chunks
+        """
+        if not os.path.isfile(self.chunks_path()):
+            return 0
+        build_dir = os.path.join(self.path, f'build-{time.time_ns()}')
+        os.makedirs(build_dir)
+        postings = defaultdict(list)
+        doclen = []
+        offsets = []
+        with self.lock, open(self.chunks_path(), 'rb') as src, open(os.path.join(build_dir, 'docs.jsonl'), 'wb') as docs:
+            for n, line in enumerate(src):
+                offsets.append(docs.tell())
+                docs.write(line)
+                counts = defaultdict(int)
+                for token in tokenize(json.loads(line)['page_content']):
+                    counts[token] += 1
+                for token, count in counts.items():
+                    postings[token].append((n, min(count, 65535)))
+                doclen.append(sum(counts.values()))
+
+        vocab = {}
+        ids = []
+        tfs = []
+        for term, entries in postings.items():
+            vocab[term] = [len(ids), len(ids) + len(entries)]
+            ids.extend(e[0] for e in entries)
+            tfs.extend(e[1] for e in entries)
+        with open(os.path.join(build_dir, 'vocab.json'), 'w', encoding='utf-8') as f:
+            json.dump(vocab, f)
+        np.save(os.path.join(build_dir, 'postings.npy'), np.asarray(ids, dtype=np.int32))
+        np.save(os.path.join(build_dir, 'tfs.npy'), np.asarray(tfs, dtype=np.uint16))
+        np.save(os.path.join(build_dir, 'doclen.npy'), np.asarray(doclen, dtype=np.int32))
+        np.save(os.path.join(build_dir, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+
+        # swap the symlink so that readers see either the old or the new index
+        link = self.current_path() + '.tmp'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(build_dir), link)
+        os.replace(link, self.current_path())
+        for entry in os.listdir(self.path):
+            if entry.startswith('build-') and entry != os.path.basename(build_dir):
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+        logger.info(f'built sparse index of {len(doclen)} chunks and {len(vocab)} terms')
+        return len(doclen)
+
+    def load(self) -> Optional[dict]:
+        """
+        Memory-maps the current index, returns None if there is none
+        """
+        current = self.current_path()
+        if not os.path.isdir(current):
+            return None
+        current = os.path.realpath(current)
+        with open(os.path.join(current, 'vocab.json'), encoding='utf-8') as f:
+            vocab = json.load(f)
+        doclen = np.load(os.path.join(current, 'doclen.npy'), mmap_mode='r')
+        if len(doclen) == 0:
+            return None
+        with open(os.path.join(current, 'docs.jsonl'), 'rb') as docs_file:
+            docs = mmap.mmap(docs_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return {
+            'vocab': vocab,
+            'postings': np.load(os.path.join(current, 'postings.npy'), mmap_mode='r'),
+            'tfs': np.load(os.path.join(current, 'tfs.npy'), mmap_mode='r'),
+            'doclen': doclen,
+            'avgdl': float(np.mean(doclen)),
+            'offsets': np.load(os.path.join(current, 'offsets.npy'), mmap_mode='r'),
+            'docs': docs,
+        }
+
+    def reload(self) -> bool:
+        self.loaded = self.load()
+        return self.loaded is not None
+
+    def document(self, index: dict, n: int) -> Document:
+        start = int(index['offsets'][n])
+        end = index['docs'].find(b'\n', start)
+        record = json.loads(index['docs'][start:end if end != -1 else len(index['docs'])])
+        return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def search(self, query: str, k: int) -> List[Document]:
+        index = self.loaded
+        if index is None:
+            return []
+        with span('keyword_search', query_stage_seconds.labels('keyword_search')):
+            return self.search_index(index, query, k)
+
+    def search_index(self, index: dict, query: str, k: int) -> List[Document]:
+        n_docs = len(index['doclen'])
+        scores = np.zeros(n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            r = index['vocab'].get(term)
+            if r is None:
+                continue
+            ids = index['postings'][r[0]:r[1]]
+            tf = index['tfs'][r[0]:r[1]].astype(np.float32)
+            df = len(ids)
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            dl = index['doclen'][ids]
+            scores[ids] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / index['avgdl']))
+        k = min(k, n_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.document(index, int(n)) for n in top if scores[n] > 0]
+
+
+sparse_index = SparseIndex(sparse_index_dir)
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int, rrf_k: int = 60) -> List[Document]:
+    scores = defaultdict(float)
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = chunk_key(doc)
+            scores[key] += 1 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the results of a dense retriever and the sparse index with
+    reciprocal rank fusion
+    """
+
+    dense: BaseRetriever
+    sparse: SparseIndex
+    k: int = 4
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        dense = self.dense.invoke(query, config={'callbacks': run_manager.get_child()})
+        return reciprocal_rank_fusion([dense, self.sparse.search(query, self.k)], self.k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        loop = asyncio.get_event_loop()
+        dense, sparse = await asyncio.gather(
+            self.dense.ainvoke(query, config={'callbacks': run_manager.get_child()}),
+            loop.run_in_executor(None, self.sparse.search, query, self.k)
+        )
+        return reciprocal_rank_fusion([dense, sparse], self.k)
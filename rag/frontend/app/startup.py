@@ -0,0 +1,48 @@
+import time
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """
+    Runs the startup steps (loading models, connecting to the database and
+    the LLM) on a background thread so that the server can bind and answer
+    probes immediately. A step that fails is retried with backoff instead of
+    crashing the pod, and the server is ready once every step has succeeded
+    """
+
+    def __init__(self, steps: List[Tuple[str, Callable[[], None]]], max_backoff: float = 30) -> None:
+        self.steps = steps
+        self.max_backoff = max_backoff
+        # step name -> 'pending', 'ready' or the last error
+        self.status = {name: 'pending' for name, _ in steps}
+        self.thread = None
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='startup', daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        start = time.monotonic()
+        for name, step in self.steps:
+            backoff = 1
+            while True:
+                step_start = time.monotonic()
+                try:
+                    step()
+                    break
+                except Exception as e:
+                    self.status[name] = f'{type(e).__name__}: {e}'
+                    logger.warning(f'startup step {name} failed, retrying in {backoff}s: {e}')
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+            self.status[name] = 'ready'
+            logger.info(f'startup step {name} took {time.monotonic() - step_start:.1f}s')
+        logger.info(f'ready after {time.monotonic() - start:.1f}s')
+
+    def ready(self) -> bool:
+        return all(s == 'ready' for s in self.status.values())
@@ -6,6 +6,21 @@ function startup() {
     ingestButton = document.getElementById('ingest-button');
     serverOutput = document.getElementById('server-output');
     spinner = document.getElementById('spinner');
+    attachToRunningJob();
+}
+
+// ingest jobs continue when the page is closed - show the progress of the
+// running job, if there is one
+function attachToRunningJob() {
+    fetch('/api/ingest/jobs')
+    .then(response => response.json())
+    .then(jobs => {
+        if (jobs.length == 0 || jobs[0].state == 'succeeded' || jobs[0].state == 'failed')
+            return;
+        appendOutput('ingest job ' + jobs[0].id + ' is running');
+        streamOutput('/api/ingest/jobs/' + jobs[0].id + '/log');
+    })
+    .catch(error => appendOutput('error: ' + error));
 }
 
 function showIngestButton(show) {
@@ -46,10 +61,14 @@ async function readStreamLineByLine(stream) {
 }
 
 function ingest() {
+    appendOutput("sending request to server...");
+    streamOutput('/api/ingest');
+}
+
+function streamOutput(url) {
     showIngestButton(false);
     showSpinner(true);
-    appendOutput("sending request to server...");
-    fetch('/api/ingest', {
+    fetch(url, {
         method: 'GET',
         headers: { 'Accept': 'text/plain'}
     })
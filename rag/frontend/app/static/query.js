@@ -5,6 +5,12 @@ var llmResponseContainer = null;
 var cursor = null;
 var sources = null;
 var spinner = null;
+var followUp = null;
+var queued = false;
+// questions start a new conversation unless follow-up is checked - answers
+// to new questions can come from the answer cache, follow-ups depend on the
+// conversation so they never do
+var sessionId = null;
 
 function startup() {
     prompt = document.getElementById('prompt');
@@ -14,6 +20,7 @@ function startup() {
     cursor = document.getElementById('cursor');
     sources = document.getElementById('sources');
     spinner = document.getElementById('spinner');
+    followUp = document.getElementById('follow-up');
 
     prompt.focus();
 }
@@ -32,6 +39,7 @@ function showSpinner(show) {
 
 function clearLLMResponse() {
     llmResponse.innerText = '';
+    queued = false;
     showCursor(true);
 }
 
@@ -99,7 +107,16 @@ function toggleSource(button, contents) {
     contents.classList.toggle("invisible");
 }
 
+function showQueuePosition(position) {
+    llmResponse.innerText = 'Waiting in queue (position ' + position + ')...';
+    queued = true;
+}
+
 function appendToLLMResponse(text) {
+    if (queued) {
+        llmResponse.innerText = '';
+        queued = false;
+    }
     llmResponse.innerText += text;
     queryButton.scrollIntoView(false);
 }
@@ -115,6 +132,14 @@ function processLine(text) {
         return
     }
     if (obj == null) return;
+    if (obj.queue_position != null) {
+        showQueuePosition(obj.queue_position);
+        return
+    }
+    if (obj.error != null) {
+        appendError(obj.error);
+        return
+    }
     if (obj.text != null) {
         appendToLLMResponse(obj.text);
         return
@@ -158,7 +183,14 @@ async function readStreamLineByLine(stream) {
     showCursor(false);
   }
 
+function newSessionId() {
+    return Date.now().toString(36) + '-' + Math.random().toString(36).substring(2);
+}
+
 function query() {
+    if (sessionId == null || !followUp.checked) {
+        sessionId = newSessionId();
+    }
     showQueryButton(false);
     showSpinner(true);
     clearLLMResponse();
@@ -167,7 +199,7 @@ function query() {
     fetch('/api/query', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json'},
-        body: JSON.stringify({ prompt: prompt.value })
+        body: JSON.stringify({ prompt: prompt.value, session_id: sessionId })
     })
     .then(response => response.body)
     .then(readStreamLineByLine)
@@ -176,6 +208,8 @@ function query() {
         showSpinner(false);
         showQueryButton(true);
         showCursor(false);
+        // the next question can continue this conversation
+        followUp.disabled = false;
     });
 }
 
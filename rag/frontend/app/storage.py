@@ -0,0 +1,74 @@
+import os
+import fnmatch
+from typing import Iterator, List, Optional, Tuple
+import boto3
+
+# only keys under the prefix that match one of the include patterns (all
+# keys if there are none) and none of the exclude patterns are ingested -
+# patterns are comma-separated shell-style wildcards, e.g. manuals/*,*.pdf
+source_prefix = os.environ.get("SOURCE_PREFIX", "")
+source_include = os.environ.get("SOURCE_INCLUDE", "")
+source_exclude = os.environ.get("SOURCE_EXCLUDE", "")
+# larger objects are streamed to a file even if they can be parsed from memory
+in_memory_max_bytes = int(os.environ.get("IN_MEMORY_MAX_BYTES", 16 * 1024 * 1024))
+
+
+def parse_patterns(value: str) -> List[str]:
+    return [p.strip() for p in value.split(',') if p.strip() != '']
+
+
+def matches(key: str, include: List[str], exclude: List[str]) -> bool:
+    if len(include) > 0 and not any(fnmatch.fnmatchcase(key, p) for p in include):
+        return False
+    return not any(fnmatch.fnmatchcase(key, p) for p in exclude)
+
+
+def client():
+    return boto3.session.Session().client(service_name='s3')
+
+
+def list_objects(bucket: str, prefix: str = source_prefix, include: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Yields the key, etag and size of the objects in the bucket that pass the
+    filters, one page of 1000 keys at a time
+    """
+    include = parse_patterns(source_include) if include is None else include
+    exclude = parse_patterns(source_exclude) if exclude is None else exclude
+    paginator = client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for f in page.get('Contents', []):
+            key = f.get('Key')
+            if key.endswith('/') or not matches(key, include, exclude):
+                continue
+            yield key, {'etag': f.get('ETag', '').strip('"'), 'size': f.get('Size', 0)}
+
+
+def download_file(s3, bucket: str, key: str, dir: str) -> str:
+    """
+    Downloads the object to a file under dir (with concurrent range requests
+    for large objects) and returns its path
+    """
+    full_path = os.path.join(dir, key)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    s3.download_file(bucket, key, full_path)
+    return full_path
+
+
+def read_object(s3, bucket: str, key: str, dir: str) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Returns (contents, None) if the object is at most in_memory_max_bytes,
+    otherwise streams it to a file under dir and returns (None, path)
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+    try:
+        if response.get('ContentLength', 0) <= in_memory_max_bytes:
+            return body.read(), None
+        full_path = os.path.join(dir, key)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            for chunk in body.iter_chunks(1024 * 1024):
+                f.write(chunk)
+        return None, full_path
+    finally:
+        body.close()
@@ -0,0 +1,71 @@
+import time
+import asyncio
+from typing import Any, AsyncIterable
+from langchain_core.callbacks import AsyncCallbackHandler
+
+
+class TokenStream(AsyncCallbackHandler):
+    """
+    Callback handler that puts the LLM's tokens on a bounded queue - when the
+    queue is full, the LLM client stops reading from the upstream response
+    until the client catches up
+    """
+
+    def __init__(self, max_queued: int) -> None:
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.tokens = 0
+        self.first_token = None
+        self.last_token = None
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if token == '':
+            return
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.tokens += 1
+        await self.queue.put(token)
+
+    async def items(self, task: asyncio.Task, max_delay: float, max_chars: int, ping_interval: float) -> AsyncIterable[dict]:
+        """
+        Yields the tokens until task is done, coalesced into {'text': ...}
+        items of up to max_chars that are held back for at most max_delay
+        (the first token is sent right away), and {'ping': True} items when
+        nothing was sent for ping_interval
+        """
+        buffer = []
+        size = 0
+        deadline = None
+        sent_first = False
+        get = None
+        try:
+            while True:
+                if get is None:
+                    get = asyncio.ensure_future(self.queue.get())
+                timeout = ping_interval if deadline is None else max(0, deadline - time.perf_counter())
+                done, _ = await asyncio.wait([get, task], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if get in done:
+                    token = get.result()
+                    get = None
+                    buffer.append(token)
+                    size += len(token)
+                    if deadline is None:
+                        deadline = time.perf_counter() + max_delay
+                    if not sent_first or size >= max_chars:
+                        sent_first = True
+                        yield {'text': ''.join(buffer)}
+                        buffer, size, deadline = [], 0, None
+                elif task in done:
+                    if self.queue.empty():
+                        break
+                elif len(buffer) > 0:
+                    yield {'text': ''.join(buffer)}
+                    buffer, size, deadline = [], 0, None
+                else:
+                    yield {'ping': True}
+            if len(buffer) > 0:
+                yield {'text': ''.join(buffer)}
+        finally:
+            if get is not None:
+                get.cancel()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Uploads a synthetic corpus to a bucket and ingests it into an in-memory
+vector store, reporting files, documents and chunks per second. Uses the
+same S3 settings as the frontend (AWS_ENDPOINT_URL_S3, AWS_ACCESS_KEY_ID,
+AWS_SECRET_ACCESS_KEY)
+
+    python3 ingest_bench.py --bucket bench-documents --files 200 --words 5000
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import concurrent.futures
+import boto3
+
+vocabulary = '''
+servo amplifier motor encoder cable parameter alarm speed torque position gain
+regenerative resistor wiring terminal connector switch setting axis controller
+signal input output voltage current power supply ground shield frequency filter
+mode operation manual automatic reset error warning display status monitor
+'''.split()
+
+
+def synthetic_document(n: int, words: int, markdown: bool) -> str:
+    rng = random.Random(n)
+    paragraphs = []
+    remaining = words
+    section = 1
+    while remaining > 0:
+        length = min(remaining, rng.randint(40, 160))
+        remaining -= length
+        if markdown and rng.random() < 0.2:
+            paragraphs.append(f'## Section {section}')
+            section += 1
+        sentences = []
+        while length > 0:
+            sentence = rng.randint(6, 20)
+            sentences.append(' '.join(rng.choice(vocabulary) for _ in range(min(sentence, length))).capitalize() + '.')
+            length -= sentence
+        paragraphs.append(' '.join(sentences))
+    return '\n\n'.join(paragraphs) + '\n'
+
+
+def upload_corpus(client, bucket: str, files: int, words: int, formats: list) -> int:
+    try:
+        client.create_bucket(Bucket=bucket)
+    except (client.exceptions.BucketAlreadyOwnedByYou, client.exceptions.BucketAlreadyExists):
+        pass
+
+    def upload(n: int) -> int:
+        ext = formats[n % len(formats)]
+        body = synthetic_document(n, words, ext == 'md').encode('utf-8')
+        client.put_object(Bucket=bucket, Key=f'bench/doc-{n:05d}.{ext}', Body=body)
+        return len(body)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        return sum(executor.map(upload, range(files)))
+
+
+async def main(args: argparse.Namespace) -> dict:
+    # settings are read when the modules are imported
+    os.environ['SOURCE_BUCKET'] = args.bucket
+    os.environ.setdefault('VECTOR_STORE', 'memory')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+    from db import get_db_connection, persist_database
+    from ingest import Ingester, list_bucket
+    from sparse import SparseIndex
+
+    client = boto3.session.Session().client(service_name='s3')
+    if not args.skip_upload:
+        start = time.monotonic()
+        size = upload_corpus(client, args.bucket, args.files, args.words, args.formats.split(','))
+        print(f'uploaded {args.files} files ({size / (1024*1024):.1f} MB) in {time.monotonic() - start:.1f}s')
+
+    files = [k for k in list_bucket() if k.startswith('bench/')]
+    sparse = None
+    if args.hybrid:
+        sparse = SparseIndex(os.path.join(os.environ.get('TMPDIR', '/tmp'), f'bench-sparse-{os.getpid()}'))
+    db = get_db_connection()
+    ingester = Ingester(args.bucket, db, sparse_index=sparse)
+    start = time.monotonic()
+    async for line in ingester.ingest(files):
+        if args.verbose:
+            print(line, end='')
+    await asyncio.get_event_loop().run_in_executor(None, persist_database)
+    if sparse is not None:
+        sparse.build()
+        sparse.clear()
+    wall = time.monotonic() - start
+
+    summary = {
+        'files': len(files),
+        'wall': wall,
+        'files_per_second': ingester.stats['embed'].files / wall,
+        'documents_per_second': ingester.stats['load'].count / wall,
+        'chunks_per_second': ingester.stats['embed'].count / wall,
+        'mb_per_second': ingester.stats['download'].count / wall,
+    }
+    print(ingester.report(start), end='')
+    print(f"ingested {len(files)} files in {wall:.1f}s: {summary['files_per_second']:.1f} files/s, {summary['documents_per_second']:.1f} documents/s, {summary['chunks_per_second']:.1f} chunks/s")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ingestion benchmark on a synthetic corpus')
+    parser.add_argument('--bucket', default='bench-documents')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--words', type=int, default=3000, help='words per file')
+    parser.add_argument('--formats', default='txt,md', help='comma-separated file extensions (txt, md) of the synthetic files')
+    parser.add_argument('--skip-upload', action='store_true', help='reuse the corpus that is already in the bucket')
+    parser.add_argument('--hybrid', action='store_true', help='also build the keyword index')
+    parser.add_argument('--verbose', action='store_true', help='print the ingestion progress')
+    parser.add_argument('--json', help='also write the summary to this file')
+    args = parser.parse_args()
+    summary = asyncio.run(main(args))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Sends queries to /api/query at a fixed rate (--qps) or with a fixed number
+of concurrent clients (--concurrency), and reports latency percentiles,
+throughput and the error rate
+
+    python3 loadgen.py --url http://127.0.0.1:8080 --concurrency 16 --duration 60
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import List, Optional
+import httpx
+import numpy as np
+
+default_prompts = [
+    'describe the dip switch settings for the 2-axis servo amplifier',
+    'how do I reset the alarm on the servo amplifier',
+    'what are the wiring requirements for the encoder cable',
+    'which parameters control the speed loop gain',
+    'what does error code AL.16 mean',
+    'how is the regenerative resistor selected',
+]
+
+
+class Result:
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.first_token = None
+        # arrival time of every streamed text item
+        self.token_times = []
+        self.end = None
+        self.error = None
+        self.queued = False
+
+
+async def run_query(client: httpx.AsyncClient, url: str, prompt: str) -> Result:
+    result = Result()
+    try:
+        async with client.stream('POST', f'{url}/api/query', json={'prompt': prompt}) as response:
+            if response.status_code != 200:
+                result.error = f'HTTP {response.status_code}'
+                return result
+            async for line in response.aiter_lines():
+                if line.strip() == '':
+                    continue
+                item = json.loads(line)
+                if 'text' in item:
+                    now = time.perf_counter()
+                    if result.first_token is None:
+                        result.first_token = now
+                    result.token_times.append(now)
+                elif 'queue_position' in item:
+                    result.queued = True
+                elif 'error' in item:
+                    result.error = str(item['error'])
+    except Exception as e:
+        result.error = f'{type(e).__name__}: {e}'
+    finally:
+        result.end = time.perf_counter()
+    return result
+
+
+def percentiles(values: List[float]) -> str:
+    if len(values) == 0:
+        return 'n/a'
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f'p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms'
+
+
+def report(results: List[Result], wall: float) -> dict:
+    ok = [r for r in results if r.error is None]
+    ttft = [r.first_token - r.start for r in ok if r.first_token is not None]
+    # the server coalesces tokens into items (STREAM_COALESCE_MS /
+    # STREAM_COALESCE_CHARS), so these are the gaps between items, not tokens
+    inter_chunk = [b - a for r in ok for a, b in zip(r.token_times, r.token_times[1:])]
+    latency = [r.end - r.start for r in ok]
+    tokens = sum(len(r.token_times) for r in ok)
+    errors = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    print(f'requests: {len(results)} in {wall:.1f}s, {len(ok) / wall:.2f} successful requests/s, {tokens / wall:.1f} streamed items/s')
+    print(f'error rate: {(len(results) - len(ok)) / max(len(results), 1):.2%}, queued: {sum(1 for r in results if r.queued)}')
+    print(f'time to first token: {percentiles(ttft)}')
+    print(f'inter-chunk latency: {percentiles(inter_chunk)}')
+    print(f'latency: {percentiles(latency)}')
+    for error, count in sorted(errors.items(), key=lambda e: -e[1])[:5]:
+        print(f'  {count} x {error}')
+
+    def summary(values):
+        return {p: float(v) for p, v in zip(('p50', 'p95', 'p99'), np.percentile(values, [50, 95, 99]))} if len(values) > 0 else None
+
+    return {
+        'requests': len(results),
+        'wall': wall,
+        'throughput': len(ok) / wall,
+        'items_per_second': tokens / wall,
+        'error_rate': (len(results) - len(ok)) / max(len(results), 1),
+        'ttft': summary(ttft),
+        'inter_chunk': summary(inter_chunk),
+        'latency': summary(latency),
+    }
+
+
+async def main(args: argparse.Namespace) -> Optional[dict]:
+    prompts = default_prompts
+    if args.prompts:
+        with open(args.prompts, encoding='utf-8') as f:
+            prompts = [line.strip() for line in f if line.strip() != '']
+    counter = 0
+
+    def next_prompt() -> str:
+        nonlocal counter
+        counter += 1
+        prompt = random.choice(prompts)
+        # unique prompts bypass the answer cache
+        return f'{prompt} ({counter})' if args.unique else prompt
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.timeout)
+    results = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        if args.qps:
+            # open loop: requests are sent on schedule, whether or not earlier ones finished
+            tasks = []
+            next_send = start
+            while next_send < deadline and (args.requests == 0 or len(tasks) < args.requests):
+                await asyncio.sleep(max(0, next_send - time.perf_counter()))
+                tasks.append(asyncio.create_task(run_query(client, args.url, next_prompt())))
+                next_send += random.expovariate(args.qps) if args.poisson else 1 / args.qps
+            results = await asyncio.gather(*tasks)
+        else:
+            # closed loop: every client sends its next request when the previous one finished
+            async def worker():
+                while time.perf_counter() < deadline and (args.requests == 0 or counter < args.requests):
+                    results.append(await run_query(client, args.url, next_prompt()))
+
+            await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    return report(results, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load generator for /api/query')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--qps', type=float, default=0, help='requests per second (open loop), overrides --concurrency')
+    parser.add_argument('--poisson', action='store_true', help='exponentially distributed gaps between requests with --qps')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients (closed loop)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to send requests for')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0 for no limit)')
+    parser.add_argument('--prompts', help='file with one prompt per line')
+    parser.add_argument('--unique', action='store_true', help='make every prompt unique so answers are not cached')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', help='also write the summary to this file')
+    args = parser.parse_args()
+    summary = asyncio.run(main(args))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    sys.exit(1 if summary['error_rate'] > 0 and summary['throughput'] == 0 else 0)
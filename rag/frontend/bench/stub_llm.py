@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Stub of the OpenAI completions endpoint served by vLLM, that streams
+generated tokens with a configurable time to first token and token rate
+
+    python3 stub_llm.py --port 8012 --ttft 0.2 --tokens-per-second 40
+"""
+import time
+import json
+import uuid
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+words = 'the servo amplifier supports position speed and torque control modes set the dip switch to select the axis'.split()
+
+app = FastAPI()
+settings = argparse.Namespace(ttft=0.2, tokens_per_second=40.0, max_tokens=128, jitter=0.1, model='/mnt/models')
+
+
+def delay(seconds: float) -> float:
+    return max(0, seconds * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+
+
+def completion(id: str, text: str, finish_reason=None) -> dict:
+    return {
+        'id': id,
+        'object': 'text_completion',
+        'created': int(time.time()),
+        'model': settings.model,
+        'choices': [{'index': 0, 'text': text, 'logprobs': None, 'finish_reason': finish_reason}],
+    }
+
+
+@app.get('/v1/models')
+async def models():
+    return {'object': 'list', 'data': [{'id': settings.model, 'object': 'model'}]}
+
+
+@app.post('/v1/completions')
+async def completions(request: Request):
+    body = await request.json()
+    max_tokens = min(body.get('max_tokens') or settings.max_tokens, settings.max_tokens)
+    id = f'cmpl-{uuid.uuid4().hex}'
+    tokens = [' ' + random.choice(words) for _ in range(max_tokens)]
+
+    async def stream():
+        await asyncio.sleep(delay(settings.ttft))
+        for i, token in enumerate(tokens):
+            if i > 0:
+                await asyncio.sleep(delay(1 / settings.tokens_per_second))
+            yield 'data: ' + json.dumps(completion(id, token)) + '\n\n'
+        yield 'data: ' + json.dumps(completion(id, '', 'length')) + '\n\n'
+        yield 'data: [DONE]\n\n'
+
+    if body.get('stream'):
+        return StreamingResponse(stream(), media_type='text/event-stream')
+    await asyncio.sleep(delay(settings.ttft + (max_tokens - 1) / settings.tokens_per_second))
+    result = completion(id, ''.join(tokens), 'length')
+    prompt_tokens = len(str(body.get('prompt', '')).split())
+    result['usage'] = {'prompt_tokens': prompt_tokens, 'completion_tokens': max_tokens, 'total_tokens': prompt_tokens + max_tokens}
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='stub OpenAI completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8012)
+    parser.add_argument('--ttft', type=float, default=settings.ttft, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=settings.tokens_per_second, help='rate of the following tokens')
+    parser.add_argument('--max-tokens', type=int, default=settings.max_tokens, help='tokens generated per request')
+    parser.add_argument('--jitter', type=float, default=settings.jitter, help='relative random variation of the delays')
+    parser.add_argument('--model', default=settings.model)
+    args = parser.parse_args()
+    settings.__dict__.update({k: v for k, v in vars(args).items() if k not in ('host', 'port')})
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
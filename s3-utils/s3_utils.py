@@ -2,9 +2,34 @@
 
 import requests
 import boto3
+import boto3.s3.transfer
+import botocore.config
+import botocore.exceptions
+import base64
+import concurrent.futures
+import hashlib
+import json
 import os
 import pathlib
+import sys
+import tempfile
+import threading
+import time
 import typing
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MB = 1024 * 1024
+
+# written next to the model files once all of them are in the bucket
+MANIFEST_NAME = 'manifest.json'
+
+# interrupted multipart uploads are resumed only if the plan that was
+# recorded here when they were started matches the upstream file
+UPLOADS_PREFIX = '.uploads/'
+
+# index files that map tensors to the shards that hold them
+SHARD_INDEX_SUFFIXES = ('.safetensors.index.json', '.bin.index.json')
 
 # extracts basename from path and strips off extension
 def model_name_from_path(p: str) -> str:
@@ -29,64 +54,487 @@ def filename_from_url(url: str) -> str:
 def log(msg: str) -> None:
     print(msg, flush=True)
 
+def env_int(key: str, default: int) -> int:
+    val = os.environ.get(key)
+    if val is None or val == '':
+        return default
+    try:
+        return int(val)
+    except ValueError:
+        raise Exception(f'{key} ({val}) is not an integer')
+
+def format_throughput(size: int, elapsed: float) -> str:
+    if elapsed <= 0:
+        elapsed = 0.001
+    return f'{size / MB:.1f} MB in {elapsed:.1f}s ({size / MB / elapsed:.1f} MB/s)'
+
+def strip_etag(etag: typing.Optional[str]) -> str:
+    if etag is None:
+        return ''
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"')
+
+def is_sha256(s: str) -> bool:
+    return len(s) == 64 and all(c in '0123456789abcdef' for c in s.lower())
+
+def part_ranges(size: int, part_size: int) -> typing.List[typing.Tuple[int, int]]:
+    # inclusive byte ranges, suitable for the HTTP Range header
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+class RemoteFile(typing.NamedTuple):
+    url: str
+    size: int
+    accepts_ranges: bool
+    etag: str
+
+    def metadata(self, verified: bool = True) -> typing.Dict[str, str]:
+        # recorded on the object so that later runs can tell whether it is
+        # current - sha256 only if the uploaded data was checked against it
+        metadata = {}
+        if self.etag != '':
+            metadata['source-etag'] = self.etag
+        if verified and is_sha256(self.etag):
+            metadata['sha256'] = self.etag
+        return metadata
+
+class HashingReader:
+    def __init__(self, raw) -> None:
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def read(self, *args) -> bytes:
+        data = self.raw.read(*args)
+        self.sha256.update(data)
+        return data
+
 class Client:
 
-    def __init__(self, access_key_id, access_secret, s3_endpoint):
+    def __init__(self, access_key_id, access_secret, s3_endpoint, max_concurrent_files: int = 4, max_concurrent_parts: int = 8, part_size: int = 64 * MB):
         if access_key_id is None or access_key_id == '':
             raise Exception('access_key_id is not set')
         if access_secret is None or access_secret == '':
             raise Exception('access_secret is not set')
         if s3_endpoint is None or s3_endpoint == '':
             raise Exception('s3_endpoint is not set')
+        if max_concurrent_files < 1 or max_concurrent_parts < 1:
+            raise Exception('concurrency must be at least 1')
+        if part_size < 5 * MB:
+            raise Exception('part_size must be at least 5 MB')
+        self.max_concurrent_files = max_concurrent_files
+        self.max_concurrent_parts = max_concurrent_parts
+        self.part_size = part_size
+
+        # every file and part worker may hold a connection at the same time
+        pool_size = max_concurrent_files + max_concurrent_parts
         session = boto3.session.Session()
         self.s3_client = session.client(
             service_name='s3',
             aws_access_key_id=access_key_id,
             aws_secret_access_key=access_secret,
-            endpoint_url=s3_endpoint
+            endpoint_url=s3_endpoint,
+            config=botocore.config.Config(max_pool_connections=pool_size)
         )
 
-    def upload_from_url_to_bucket(self, url: str, bucket: str, model_name: str) -> None:
-        r = requests.get(url, stream=True)
-        self.s3_client.upload_fileobj(r.raw, bucket, model_name + '/' + filename_from_url(url))
+        self.http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
 
-    def download_from_bucket(self, bucket: str) -> None:
-        resp = self.s3_client.list_objects_v2(Bucket=bucket)
-        if resp is None:
-            log('could not get response')
-            return
-        contents = resp.get('Contents')
-        if contents is None:
+        # parts are uploaded from a pool shared by all files; the semaphore
+        # bounds the number of parts buffered in memory to one per worker
+        self.part_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_parts, thread_name_prefix='part')
+        self.parts_in_memory = threading.BoundedSemaphore(max_concurrent_parts)
+
+        # used for downloads, every file gets its own ranged GET threads
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max(1, max_concurrent_parts // max_concurrent_files),
+            use_threads=True
+        )
+
+    def probe_url(self, url: str) -> RemoteFile:
+        """
+        Returns the final URL after redirects, the content length (-1 if
+        unknown), whether the server accepts range requests and the ETag
+        """
+        r = self.http.head(url, allow_redirects=True, timeout=60)
+        r.raise_for_status()
+        size = int(r.headers.get('Content-Length', '-1'))
+        if r.headers.get('Content-Encoding') not in (None, 'identity'):
+            # content length is the compressed size
+            size = -1
+        accepts_ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        etag = strip_etag(r.headers.get('ETag'))
+        # Hugging Face returns the sha256 and size of LFS files on the
+        # redirect, the CDN's own ETag is not stable
+        for h in r.history:
+            if h.headers.get('X-Linked-Etag') is not None:
+                etag = strip_etag(h.headers.get('X-Linked-Etag'))
+            if size < 0 and h.headers.get('X-Linked-Size') is not None:
+                size = int(h.headers.get('X-Linked-Size'))
+        return RemoteFile(r.url, size, accepts_ranges, etag)
+
+    def object_matches(self, bucket: str, key: str, remote: RemoteFile) -> bool:
+        try:
+            obj = self.s3_client.head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        if remote.size < 0 or obj.get('ContentLength') != remote.size:
+            return False
+        if remote.etag == '':
+            return True
+        metadata = obj.get('Metadata', {})
+        return remote.etag in (metadata.get('source-etag'), metadata.get('sha256'), strip_etag(obj.get('ETag')))
+
+    def upload_from_url_to_bucket(self, url: str, bucket: str, model_name: str, remote: typing.Optional[RemoteFile] = None) -> int:
+        key = model_name + '/' + filename_from_url(url)
+        start = time.monotonic()
+        if remote is None:
+            remote = self.probe_url(url)
+        if self.object_matches(bucket, key, remote):
+            log(f'skipping {key}, object in bucket matches upstream')
+            return 0
+        if remote.size > self.part_size and remote.accepts_ranges:
+            transferred = self.upload_multipart(remote, bucket, key)
+        else:
+            with self.http.get(remote.url, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                reader = HashingReader(r.raw)
+                self.s3_client.upload_fileobj(reader, bucket, key, ExtraArgs={'Metadata': remote.metadata(verified=False)})
+            if is_sha256(remote.etag):
+                if reader.sha256.hexdigest() != remote.etag:
+                    self.s3_client.delete_object(Bucket=bucket, Key=key)
+                    raise Exception(f'sha256 of {key} does not match upstream')
+                # the sha256 is recorded once it has been checked
+                self.s3_client.copy({'Bucket': bucket, 'Key': key}, bucket, key, ExtraArgs={'Metadata': remote.metadata(), 'MetadataDirective': 'REPLACE'}, Config=self.transfer_config)
+            transferred = self.s3_client.head_object(Bucket=bucket, Key=key).get('ContentLength', 0)
+        log(f'uploaded {key}: {format_throughput(transferred, time.monotonic() - start)}')
+        return transferred
+
+    def upload_part_from_url(self, url: str, bucket: str, key: str, upload_id: str, part_number: int, first: int, last: int) -> dict:
+        attempts = 3
+        for attempt in range(attempts):
+            try:
+                # the body is only read once the server has confirmed the
+                # range, a server that ignores it would send the whole file
+                with self.http.get(url, headers={'Range': f'bytes={first}-{last}'}, stream=True, timeout=60) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise Exception(f'expected partial content, got HTTP {r.status_code}')
+                    length = r.headers.get('Content-Length')
+                    if length is not None and int(length) != last - first + 1:
+                        raise Exception(f'expected {last - first + 1} bytes, got Content-Length {length}')
+                    data = r.content
+                if len(data) != last - first + 1:
+                    raise Exception(f'expected {last - first + 1} bytes, got {len(data)}')
+                # lets S3 reject parts that were corrupted in transit
+                md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+                resp = self.s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data, ContentMD5=md5)
+                return {'PartNumber': part_number, 'ETag': resp['ETag']}
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise
+                log(f'retrying part {part_number} of {key}: {e}')
+                time.sleep(2 ** attempt)
+
+    def read_upload_plan(self, bucket: str, key: str) -> dict:
+        try:
+            body = self.s3_client.get_object(Bucket=bucket, Key=UPLOADS_PREFIX + key + '.json')['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return {}
+            raise
+        return json.loads(body)
+
+    def write_upload_plan(self, bucket: str, key: str, upload_id: str, remote: RemoteFile) -> None:
+        plan = {'upload-id': upload_id, 'source-etag': remote.etag, 'size': remote.size, 'part-size': self.part_size}
+        self.s3_client.put_object(Bucket=bucket, Key=UPLOADS_PREFIX + key + '.json', Body=json.dumps(plan).encode('utf-8'), ContentType='application/json')
+
+    def delete_upload_plan(self, bucket: str, key: str) -> None:
+        self.s3_client.delete_object(Bucket=bucket, Key=UPLOADS_PREFIX + key + '.json')
+
+    def find_resumable_upload(self, bucket: str, key: str, remote: RemoteFile, ranges: typing.List[typing.Tuple[int, int]]) -> typing.Tuple[typing.Optional[str], typing.Dict[int, dict]]:
+        """
+        Looks for an interrupted multipart upload of key that was started for
+        the same upstream file and split the same way, and returns its upload
+        ID and the parts that completed. Uploads that cannot be resumed are
+        aborted.
+        """
+        uploads = self.s3_client.list_multipart_uploads(Bucket=bucket, Prefix=key).get('Uploads', [])
+        uploads = sorted([u for u in uploads if u.get('Key') == key], key=lambda u: u.get('Initiated'), reverse=True)
+        plan = self.read_upload_plan(bucket, key) if len(uploads) > 0 else {}
+        upload_id = None
+        completed = {}
+        for upload in uploads:
+            # parts of a file that changed upstream since the upload was
+            # started must not be reused, even if they have the same size
+            if upload_id is None and remote.etag != '' and plan.get('upload-id') == upload['UploadId'] and plan.get('source-etag') == remote.etag:
+                parts = []
+                paginator = self.s3_client.get_paginator('list_parts')
+                for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload['UploadId']):
+                    parts.extend(page.get('Parts', []))
+                # parts that do not fit the current plan mean that the part
+                # size or the size of the upstream file changed
+                if all(p['PartNumber'] <= len(ranges) and p['Size'] == ranges[p['PartNumber'] - 1][1] - ranges[p['PartNumber'] - 1][0] + 1 for p in parts):
+                    upload_id = upload['UploadId']
+                    completed = {p['PartNumber']: {'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in parts}
+                    continue
+            log(f'aborting stale multipart upload of {key}')
+            self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload['UploadId'])
+        return upload_id, completed
+
+    def upload_multipart(self, remote: RemoteFile, bucket: str, key: str) -> int:
+        """
+        Uploads remote in parts and returns the number of bytes transferred.
+        Parts of an earlier interrupted upload are not transferred again.
+        """
+        ranges = part_ranges(remote.size, self.part_size)
+        upload_id, completed = self.find_resumable_upload(bucket, key, remote, ranges)
+        if upload_id is None:
+            log(f'uploading {key} in {len(ranges)} parts')
+            # parts are checked with their MD5, the sha256 of the whole file
+            # is not computed for multipart uploads
+            upload_id = self.s3_client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=remote.metadata(verified=False))['UploadId']
+            self.write_upload_plan(bucket, key, upload_id, remote)
+        else:
+            log(f'resuming upload of {key}, {len(completed)} of {len(ranges)} parts already uploaded')
+        futures = []
+        transferred = 0
+        try:
+            for i, (first, last) in enumerate(ranges):
+                if i + 1 in completed:
+                    continue
+                self.parts_in_memory.acquire()
+                try:
+                    future = self.part_executor.submit(self.upload_part_from_url, remote.url, bucket, key, upload_id, i + 1, first, last)
+                except:
+                    self.parts_in_memory.release()
+                    raise
+                # also runs when the part is cancelled before it starts
+                future.add_done_callback(lambda _: self.parts_in_memory.release())
+                futures.append(future)
+                transferred += last - first + 1
+            for f in futures:
+                part = f.result()
+                completed[part['PartNumber']] = part
+            parts = [completed[n] for n in sorted(completed)]
+            self.s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+            self.delete_upload_plan(bucket, key)
+        except:
+            # the upload is left in place so that the next run can resume it
+            for f in futures:
+                f.cancel()
+            raise
+        size = self.s3_client.head_object(Bucket=bucket, Key=key).get('ContentLength')
+        if size != remote.size:
+            self.s3_client.delete_object(Bucket=bucket, Key=key)
+            raise Exception(f'size of {key} ({size}) does not match upstream ({remote.size})')
+        return transferred
+
+    def list_bucket(self, bucket: str, prefix: str = '') -> typing.List[dict]:
+        entries = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for entry in page.get('Contents', []):
+                key = entry.get('Key')
+                if key is None or key.endswith('/'):
+                    # directory marker
+                    continue
+                if key.startswith(UPLOADS_PREFIX):
+                    # plan of an upload in progress
+                    continue
+                entries.append(entry)
+        return entries
+
+    def download_object(self, bucket: str, entry: dict, dest_dir: str) -> int:
+        """
+        Downloads an object unless a local file with the same size and
+        modification time exists, and returns the number of bytes transferred
+        """
+        key = entry['Key']
+        dest = os.path.abspath(os.path.join(dest_dir, key))
+        if os.path.commonpath([os.path.abspath(dest_dir), dest]) != os.path.abspath(dest_dir):
+            raise Exception(f'key {key} points outside of {dest_dir}')
+        size = entry.get('Size')
+        mtime = entry['LastModified'].timestamp()
+        try:
+            st = os.stat(dest)
+            if st.st_size == size and int(st.st_mtime) == int(mtime):
+                return 0
+        except FileNotFoundError:
+            pass
+
+        dir = pathlib.Path(dest).parent
+        dir.mkdir(parents=True, exist_ok=True)
+        # download to a temporary file in the same directory so that the
+        # rename is atomic and readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=dir, prefix='.' + pathlib.Path(dest).name + '.')
+        os.close(fd)
+        try:
+            self.s3_client.download_file(bucket, key, tmp, Config=self.transfer_config)
+            os.utime(tmp, (mtime, mtime))
+            os.replace(tmp, dest)
+        except:
+            os.remove(tmp)
+            raise
+        return size
+
+    def download_from_bucket(self, bucket: str, dest_dir: str = '.', prefix: str = '') -> None:
+        """
+        Syncs the objects in the bucket to dest_dir
+        """
+        start = time.monotonic()
+        entries = self.list_bucket(bucket, prefix)
+        if len(entries) == 0:
             log('bucket had no contents')
             return
-        for entry in contents:
-            key = entry.get('Key')
-            if key is None:
-                continue
-            dir = pathlib.Path(key).parent
-            if not dir.is_dir():
-                # directory does not exist - we need to create it ahead of time
-                dir.mkdir(parents=True, exist_ok=True)
-            log(f'downloading {key}')
-            self.s3_client.download_file(bucket, key, key)
+        failed = []
+        transferred = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_files, thread_name_prefix='file') as executor:
+            futures = {executor.submit(self.download_object, bucket, entry, dest_dir): entry['Key'] for entry in entries}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                if future.exception() is not None:
+                    log(f'error downloading {key}: {future.exception()}')
+                    failed.append(key)
+                elif future.result() > 0:
+                    log(f'downloaded {key}')
+                    transferred += future.result()
+        if len(failed) > 0:
+            raise Exception(f'could not download {len(failed)} of {len(entries)} objects from {bucket}')
+        log(f'synced {len(entries)} objects from {bucket} to {dest_dir}, transferred {format_throughput(transferred, time.monotonic() - start)}')
+
+    def shards_from_index(self, url: str) -> typing.Set[str]:
+        r = self.http.get(url, timeout=60)
+        r.raise_for_status()
+        weight_map = r.json().get('weight_map')
+        if not isinstance(weight_map, dict):
+            raise Exception(f'{url} does not contain a weight_map')
+        return set(weight_map.values())
+
+    def plan_model_upload(self, model_name: str, urls: typing.List[str]) -> typing.List[typing.Tuple[str, RemoteFile]]:
+        """
+        Probes every URL, checks that the shards referenced by the index files
+        are all in the list, and returns the transfers ordered largest-first
+        so that the biggest shards do not end up as the long tail
+        """
+        filenames = {filename_from_url(url) for url in urls}
+        missing = set()
+        for url in urls:
+            if filename_from_url(url).endswith(SHARD_INDEX_SUFFIXES):
+                shards = self.shards_from_index(url)
+                log(f'{filename_from_url(url)} references {len(shards)} shards')
+                missing |= shards - filenames
+        if len(missing) > 0:
+            raise Exception(f'shards missing from the list of files for {model_name}: {", ".join(sorted(missing))}')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_files, thread_name_prefix='probe') as executor:
+            remotes = list(executor.map(self.probe_url, urls))
+        plan = sorted(zip(urls, remotes), key=lambda t: t[1].size, reverse=True)
+        total = sum(remote.size for remote in remotes if remote.size > 0)
+        log(f'{model_name}: {len(plan)} files, {total / MB:.1f} MB')
+        return plan
+
+    def write_manifest(self, bucket: str, model_name: str, urls: typing.List[str]) -> None:
+        files = {}
+        for url in urls:
+            filename = filename_from_url(url)
+            obj = self.s3_client.head_object(Bucket=bucket, Key=model_name + '/' + filename)
+            metadata = obj.get('Metadata', {})
+            files[filename] = {
+                'url': url,
+                'size': obj.get('ContentLength'),
+                'etag': strip_etag(obj.get('ETag')),
+                'source-etag': metadata.get('source-etag', ''),
+                'sha256': metadata.get('sha256', '')
+            }
+        manifest = {'model': model_name, 'files': files}
+        self.s3_client.put_object(Bucket=bucket, Key=model_name + '/' + MANIFEST_NAME, Body=json.dumps(manifest, indent=2).encode('utf-8'), ContentType='application/json')
+        log(f'wrote manifest for {len(files)} files to {model_name}/{MANIFEST_NAME}')
+
+    def verify_model_in_bucket(self, bucket: str, model_name: str) -> typing.List[str]:
+        """
+        Checks the objects in the bucket against the model's manifest and
+        returns a list of problems - the list is empty if the model is complete
+        """
+        try:
+            body = self.s3_client.get_object(Bucket=bucket, Key=model_name + '/' + MANIFEST_NAME)['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            return [f'could not read manifest: {e}']
+        expected = json.loads(body).get('files', {})
+        actual = {entry['Key'][len(model_name) + 1:]: entry.get('Size') for entry in self.list_bucket(bucket, model_name + '/')}
+        problems = []
+        for filename, info in expected.items():
+            if filename not in actual:
+                problems.append(f'{filename} is missing')
+            elif actual[filename] != info.get('size'):
+                problems.append(f'{filename} has {actual[filename]} bytes, expected {info.get("size")}')
+        return problems
 
     def upload_model_to_bucket(self, bucket, model_name, urls) -> None:
         if bucket is None or bucket == '':
             raise Exception('bucket is not set')
-        for url in urls:
-            url = url.strip()
-            if len(url) == 0:
-                continue
-            log(f'uploading {url}')
-            self.upload_from_url_to_bucket(url, bucket, model_name)
+        urls = [url.strip() for url in urls if len(url.strip()) > 0]
+        start = time.monotonic()
+        plan = self.plan_model_upload(model_name, urls)
+        failed = []
+        transferred = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_files, thread_name_prefix='file') as executor:
+            futures = {}
+            for url, remote in plan:
+                log(f'uploading {url}')
+                futures[executor.submit(self.upload_from_url_to_bucket, url, bucket, model_name, remote)] = url
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    log(f'error uploading {futures[future]}: {future.exception()}')
+                    failed.append(futures[future])
+                else:
+                    transferred += future.result()
+        if len(failed) > 0:
+            raise Exception(f'could not upload {len(failed)} of {len(urls)} files for {model_name}')
+        self.write_manifest(bucket, model_name, urls)
+        log(f'{model_name} is up to date in {bucket}, transferred {format_throughput(transferred, time.monotonic() - start)}')
 
 
 if __name__ == '__main__':
     client = Client(
         os.environ.get('AWS_ACCESS_KEY_ID'),
         os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        os.environ.get('AWS_ENDPOINT_URL_S3')
+        os.environ.get('AWS_ENDPOINT_URL_S3'),
+        max_concurrent_files=env_int('MAX_CONCURRENT_FILES', 4),
+        max_concurrent_parts=env_int('MAX_CONCURRENT_PARTS', 8),
+        part_size=env_int('PART_SIZE_MB', 64) * MB
     )
+    bucket = os.environ.get('S3_BUCKET', 'models')
+    action = os.environ.get('ACTION', 'upload')
+    if action == 'download':
+        # warms a local model cache, e.g. from an init container on a GPU node
+        client.download_from_bucket(bucket, os.environ.get('DOWNLOAD_DIR', '.'), os.environ.get('S3_PREFIX', ''))
+        sys.exit(0)
+    if action == 'verify':
+        # lets a model server check a single object before loading the model
+        model_name = os.environ.get('MODEL_NAME', '')
+        if model_name == '':
+            raise Exception('MODEL_NAME environment variable is not set')
+        problems = client.verify_model_in_bucket(bucket, model_name)
+        for problem in problems:
+            log(f'{model_name}: {problem}')
+        if len(problems) > 0:
+            sys.exit(1)
+        log(f'{model_name} is complete')
+        sys.exit(0)
+    if action != 'upload':
+        raise Exception(f'unknown ACTION {action}')
+
     model_paths = os.environ.get('MODELS')
     if model_paths is None:
         raise Exception('MODELS environment variable is not set')
@@ -102,4 +550,4 @@ if __name__ == '__main__':
         if len(model_urls) == 0:
             log(f'could not get urls from {model_path}')
             continue
-        client.upload_model_to_bucket(os.environ.get('S3_BUCKET', 'models'), model_name, model_urls)
+        client.upload_model_to_bucket(bucket, model_name, model_urls)
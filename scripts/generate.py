@@ -1,6 +1,265 @@
 #!/usr/bin/env python3
+"""
+Batch generation from a JSONL file of prompts, e.g.
 
-from vllm import LLM
+    {"id": "q1", "prompt": "the quick brown fox", "max_tokens": 64}
 
-llm = LLM(model='/data/vicuna/', gpu_memory_utilization=0.8)
-print(llm.generate('the quick brown fox'))
+Prompts are read from a local file or an S3 object (s3://bucket/key) and sent
+to the OpenAI-compatible completions endpoint of the InferenceService with
+bounded concurrency, so that vLLM can batch them, or generated with vLLM in
+this process (--backend vllm). Results are appended to the output file as
+they complete, and a restarted run skips the prompts that already have a
+result.
+
+    ./generate.py prompts.jsonl --output results.jsonl --url http://llm-internal:8012/v1 --concurrency 64
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Iterator, Optional, Set, Tuple
+
+
+def read_lines(source: str) -> Iterator[str]:
+    if source.startswith('s3://'):
+        import boto3
+        bucket, _, key = source[len('s3://'):].partition('/')
+        body = boto3.session.Session().client(service_name='s3').get_object(Bucket=bucket, Key=key)['Body']
+        for line in body.iter_lines():
+            yield line.decode('utf-8')
+    else:
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                yield line
+
+
+def read_prompts(source: str, prompt_field: str, id_field: str, done: Set[str]) -> Iterator[Tuple[str, dict]]:
+    """
+    Yields (id, record) for every prompt that does not have a result yet -
+    prompts without an id are identified by their line number
+    """
+    for n, line in enumerate(read_lines(source), start=1):
+        if line.strip() == '':
+            continue
+        record = json.loads(line)
+        id = str(record.get(id_field, n))
+        if id in done:
+            continue
+        if prompt_field not in record:
+            print(f'line {n} has no {prompt_field} field, skipping', file=sys.stderr)
+            continue
+        yield id, record
+
+
+def completed_ids(output: str) -> Set[str]:
+    """
+    Returns the ids of the successful results in an earlier output file
+    """
+    done = set()
+    if not os.path.isfile(output):
+        return done
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run may be incomplete
+                continue
+            if 'error' not in result:
+                done.add(result['id'])
+    return done
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, result: dict) -> None:
+        if 'error' in result:
+            self.failed += 1
+            return
+        self.completed += 1
+        self.prompt_tokens += result.get('prompt_tokens', 0)
+        self.completion_tokens += result.get('completion_tokens', 0)
+
+    def report(self) -> str:
+        wall = max(time.monotonic() - self.start, 0.001)
+        return f'{self.completed} completed, {self.failed} failed in {wall:.0f}s - {self.completion_tokens / wall:.1f} generated tokens/s, {(self.prompt_tokens + self.completion_tokens) / wall:.1f} total tokens/s, {self.completed / wall:.2f} requests/s'
+
+
+class ResultWriter:
+    def __init__(self, output: str, stats: Stats) -> None:
+        self.file = open(output, 'a', encoding='utf-8')
+        self.stats = stats
+
+    def write(self, result: dict) -> None:
+        self.file.write(json.dumps(result) + '\n')
+        # every result that is written survives an interruption
+        self.file.flush()
+        self.stats.add(result)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+async def generate_openai(args: argparse.Namespace, prompts: Iterator[Tuple[str, dict]], writer: ResultWriter) -> None:
+    import httpx
+
+    async def complete(client: httpx.AsyncClient, id: str, record: dict) -> dict:
+        body = {
+            'model': args.model,
+            'prompt': record[args.prompt_field],
+            'max_tokens': record.get('max_tokens', args.max_tokens),
+            'temperature': record.get('temperature', args.temperature),
+        }
+        for attempt in range(args.retries + 1):
+            try:
+                response = await client.post(f'{args.url.rstrip("/")}/completions', json=body)
+                # rate limiting and server errors are worth retrying, client errors are not
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise Exception(f'HTTP {response.status_code}: {response.text[:200]}')
+                if response.status_code != 200:
+                    return {'id': id, 'error': f'HTTP {response.status_code}: {response.text[:200]}'}
+                completion = response.json()
+                usage = completion.get('usage') or {}
+                return {
+                    'id': id,
+                    'text': completion['choices'][0]['text'],
+                    'finish_reason': completion['choices'][0].get('finish_reason'),
+                    'prompt_tokens': usage.get('prompt_tokens', 0),
+                    'completion_tokens': usage.get('completion_tokens', 0),
+                }
+            except Exception as e:
+                if attempt == args.retries:
+                    return {'id': id, 'error': f'{type(e).__name__}: {e}'}
+                await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+
+    async def producer():
+        loop = asyncio.get_event_loop()
+        # the prompts are read in a thread because reading from S3 blocks
+        iterator = iter(prompts)
+        while True:
+            item = await loop.run_in_executor(None, next, iterator, None)
+            if item is None:
+                break
+            await queue.put(item)
+        for _ in range(args.concurrency):
+            await queue.put(None)
+
+    async def worker(client: httpx.AsyncClient):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            writer.write(await complete(client, *item))
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            print(writer.stats.report(), flush=True)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    headers = {'Authorization': f'Bearer {args.api_key}'}
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout), headers=headers) as client:
+        report_task = asyncio.create_task(reporter())
+        try:
+            await asyncio.gather(producer(), *[worker(client) for _ in range(args.concurrency)])
+        finally:
+            report_task.cancel()
+
+
+def generate_vllm(args: argparse.Namespace, prompts: Iterator[Tuple[str, dict]], writer: ResultWriter) -> None:
+    from vllm import LLM, SamplingParams
+
+    llm = LLM(model=args.model, gpu_memory_utilization=args.gpu_memory_utilization)
+    last_report = time.monotonic()
+
+    def flush(batch):
+        # vLLM schedules the whole batch with continuous batching
+        sampling_params = [SamplingParams(max_tokens=r.get('max_tokens', args.max_tokens), temperature=r.get('temperature', args.temperature)) for _, r in batch]
+        outputs = llm.generate([r[args.prompt_field] for _, r in batch], sampling_params)
+        for (id, _), output in zip(batch, outputs):
+            writer.write({
+                'id': id,
+                'text': output.outputs[0].text,
+                'finish_reason': output.outputs[0].finish_reason,
+                'prompt_tokens': len(output.prompt_token_ids),
+                'completion_tokens': len(output.outputs[0].token_ids),
+            })
+
+    batch = []
+    for item in prompts:
+        batch.append(item)
+        if len(batch) >= args.batch_size:
+            flush(batch)
+            batch = []
+            if time.monotonic() - last_report >= args.report_interval:
+                print(writer.stats.report(), flush=True)
+                last_report = time.monotonic()
+    if len(batch) > 0:
+        flush(batch)
+
+
+def vllm_available() -> bool:
+    try:
+        import vllm
+        return True
+    except ImportError:
+        return False
+
+
+def main(parser: argparse.ArgumentParser) -> Optional[int]:
+    args = parser.parse_args()
+    backend = args.backend
+    if backend == 'auto':
+        backend = 'openai' if args.url else ('vllm' if vllm_available() else None)
+    if backend is None:
+        parser.error('set --url (or OPENAI_API_BASE), or install vllm')
+    if backend == 'openai' and not args.url:
+        parser.error('--backend openai requires --url (or OPENAI_API_BASE)')
+    done = completed_ids(args.output)
+    if len(done) > 0:
+        print(f'resuming, {len(done)} prompts already have results in {args.output}')
+
+    stats = Stats()
+    writer = ResultWriter(args.output, stats)
+    prompts = read_prompts(args.input, args.prompt_field, args.id_field, done)
+    try:
+        if backend == 'openai':
+            asyncio.run(generate_openai(args, prompts, writer))
+        else:
+            generate_vllm(args, prompts, writer)
+    finally:
+        writer.close()
+        print(stats.report())
+    return 1 if stats.failed > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batch generation from a JSONL file of prompts')
+    parser.add_argument('input', help='JSONL file or s3://bucket/key')
+    parser.add_argument('--output', default='results.jsonl', help='JSONL file that results are appended to')
+    parser.add_argument('--backend', choices=['auto', 'openai', 'vllm'], default='auto', help='auto uses --url if set, in-process vLLM otherwise')
+    parser.add_argument('--url', default=os.environ.get('OPENAI_API_BASE'), help='base URL of the OpenAI-compatible API, e.g. http://llm-internal:8012/v1')
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY', 'EMPTY'))
+    parser.add_argument('--model', default=os.environ.get('MODEL', '/mnt/models'))
+    parser.add_argument('--prompt-field', default='prompt')
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--max-tokens', type=int, default=256)
+    parser.add_argument('--temperature', type=float, default=0)
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight with the openai backend')
+    parser.add_argument('--batch-size', type=int, default=256, help='prompts per generate() call with the vllm backend')
+    parser.add_argument('--gpu-memory-utilization', type=float, default=0.8)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between progress reports')
+    sys.exit(main(parser))